@@ -6,6 +6,8 @@ import argparse
 import shutil
 import glob
 import re
+import json
+import datetime
 import lief
 
 from subprocess import Popen, check_output, PIPE, run
@@ -16,7 +18,7 @@ from reel import Python
 from reel import Reel
 from reel import Shell
 from reel.patch import UpdateConfigSub
-from reel.util import dedent
+from reel.util import dedent, indent, StateStore
 
 r = Reel()
 
@@ -281,20 +283,23 @@ for t in toolchains:
         configure_args={
             '--with-zlib': True,
             '--with-protoc': os.path.join('{parent_prefix_dir}', 'bin', 'protoc')
-        }
+        },
+        depends_on=['zlib']
     )
 
     t.add_library(
         name='expat',
         url='https://github.com/libexpat/libexpat/releases/download/R_2_2_5/expat-2.2.5.tar.bz2',
-        configure_args={'--without-docbook': True}
+        configure_args={'--without-docbook': True},
+        depends_on=[]
     )
 
-    t.add_library(name='ffi', url='https://github.com/libffi/libffi/archive/v3.2.1.tar.gz')
+    t.add_library(name='ffi', url='https://github.com/libffi/libffi/archive/v3.2.1.tar.gz', depends_on=[])
 
     t.add_library(
         name='png',
         url='https://downloads.sourceforge.net/project/libpng/libpng16/1.6.34/libpng-1.6.34.tar.xz',
+        depends_on=['zlib'],
     )
 
     t.add_library(
@@ -307,7 +312,8 @@ for t in toolchains:
             'ac_cv_sizeof_long': '8',
             'ac_cv_sizeof_long_long': '8',
             'libelf_cv_int64': 'long'
-        }
+        },
+        depends_on=[]
     )
 
     t.add_library(
@@ -316,7 +322,8 @@ for t in toolchains:
         configure_args={
             '--enable-utf': True,
             '--enable-unicode-properties': True
-        }
+        },
+        depends_on=[]
     )
 
     t.add_library(
@@ -341,7 +348,8 @@ for t in toolchains:
         url='http://www.bytereef.org/software/mpdecimal/releases/mpdecimal-2.4.2.tar.gz',
         phases=[UpdateConfigSub],
         in_source_build=True,
-        build_targets=['default']
+        build_targets=['default'],
+        depends_on=[]
     )
 
     t.add_library(
@@ -468,7 +476,8 @@ for t in toolchains:
         url='https://github.com/Fastcode/NUClear/archive/master.tar.gz',
         configure_args={
             '-DBUILD_TESTS': 'OFF',
-        }
+        },
+        depends_on=[]
     )
 
     t.add_library(
@@ -484,10 +493,11 @@ for t in toolchains:
             'BINARY': '64',
             'NUM_THREADS': '2',
             'HOSTCC': t.parent_toolchain.env['CC']
-        }
+        },
+        depends_on=[]
     )
 
-    t.add_library(name='libsvm', url='https://github.com/Bidski/libsvm/archive/v322.tar.gz')
+    t.add_library(name='libsvm', url='https://github.com/Bidski/libsvm/archive/v322.tar.gz', depends_on=[])
 
     t.add_library(
         name='armadillo',
@@ -497,7 +507,8 @@ for t in toolchains:
             '-DLAPACK_LIBRARY': os.path.join('{prefix_dir}', 'lib', 'libopenblas.so'),
             '-DARPACK_LIBRARY': os.path.join('{prefix_dir}', 'lib', 'libopenblas.so'),
             '-DDETECT_HDF5': 'OFF'
-        }
+        },
+        depends_on=['openblas']
     )
 
     t.add_library(
@@ -506,7 +517,8 @@ for t in toolchains:
         configure_args={
             '-DYAML_CPP_BUILD_CONTRIB': 'OFF',
             '-DYAML_CPP_BUILD_TOOLS': 'OFF'
-        }
+        },
+        depends_on=[]
     )
 
     # Double precision FFTW3 library
@@ -516,7 +528,8 @@ for t in toolchains:
         configure_args={
             '--enable-openmp': True,
             '--enable-threads': True
-        }
+        },
+        depends_on=[]
     )
 
     # Single precision FFTW3 library
@@ -528,16 +541,18 @@ for t in toolchains:
             '--enable-openmp': True,
             '--enable-threads': True,
             '--enable-float': True
-        }
+        },
+        depends_on=[]
     )
 
     t.add_library(
         name='jpeg-turbo',
         url='http://downloads.sourceforge.net/project/libjpeg-turbo/1.5.3/libjpeg-turbo-1.5.3.tar.gz',
-        configure_args={'CCASFLAGS': '-f elf64'}
+        configure_args={'CCASFLAGS': '-f elf64'},
+        depends_on=[]
     )
 
-    t.add_library(name='fmt', url='https://github.com/fmtlib/fmt/archive/4.1.0.tar.gz')
+    t.add_library(name='fmt', url='https://github.com/fmtlib/fmt/archive/4.1.0.tar.gz', depends_on=[])
 
     t.add_library(
         name='portaudio', url='http://www.portaudio.com/archives/pa_stable_v19_20140130.tgz', phases=[UpdateConfigSub]
@@ -549,7 +564,8 @@ for t in toolchains:
         configure_args={
             # Eigen doesn't know how to MinSizeRel
             '-DCMAKE_BUILD_TYPE': 'RelWithDebInfo'
-        }
+        },
+        depends_on=[]
     )
 
     t.add_library(
@@ -626,9 +642,9 @@ for t in toolchains:
         }
     )
 
-    t.add_library(name='fswatch', url='https://github.com/emcrisostomo/fswatch/archive/1.11.2.tar.gz')
+    t.add_library(name='fswatch', url='https://github.com/emcrisostomo/fswatch/archive/1.11.2.tar.gz', depends_on=[])
 
-    t.add_library(name='libuv', url='https://github.com/libuv/libuv/archive/v1.19.2.tar.gz')
+    t.add_library(name='libuv', url='https://github.com/libuv/libuv/archive/v1.19.2.tar.gz', depends_on=[])
 
     t.add_library(name='udev', url='https://dev.gentoo.org/~blueness/eudev/eudev-3.2.5.tar.gz')
 
@@ -687,11 +703,57 @@ for t in toolchains:
             Shell(configure=''),
             Shell(build=''),
             Shell(install='cp -v {} {}'.format('{source}', os.path.join('{prefix_dir}', 'include')))
-        ]
+        ],
+        depends_on=[]
     )
 
 def build():
-    r.build()
+    r.build(
+        jobs=args.jobs,
+        parallel=args.parallel_toolchains,
+        fetch_jobs=args.fetch_jobs,
+        cache=args.cache,
+        offline=args.offline,
+        stream_extract=args.stream_extract
+    )
+
+def plan():
+    result = r.plan(cache=args.cache)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    colours = {'up to date': 'green', 'stale': 'yellow', 'missing': 'red'}
+
+    for t in result['toolchains']:
+        cprint('Toolchain {}'.format(t['name']), 'cyan', attrs=['bold'])
+
+        for l in t['libraries']:
+            pending = ['{} ({})'.format(p, s) for p, s in l['phases'].items() if s != 'up to date']
+            remaining = datetime.timedelta(seconds=round(l['remaining'])) if l['remaining'] is not None else 'unknown'
+
+            cprint(indent('{}: {}'.format(l['name'], l['status']), 4), colours[l['status']], attrs=['bold'])
+            if pending:
+                print(indent('Runs {} (estimated {})'.format(', '.join(pending), remaining), 8))
+
+    if result['up_to_date']:
+        cprint('Everything is up to date', 'green', attrs=['bold'])
+        return
+
+    # Libraries we have never built don't have anything to estimate from
+    unknown = [
+        l['name'] for t in result['toolchains'] for l in t['libraries']
+        if l['status'] != 'up to date' and l['remaining'] is None
+    ]
+    cprint(
+        'Estimated time remaining: {}{}'.format(
+            datetime.timedelta(seconds=round(result['remaining'])),
+            ' plus {} libraries that have never been built'.format(len(unknown)) if unknown else ''
+        ),
+        'cyan',
+        attrs=['bold']
+    )
 
     # libasound2    Dont know if we actually need this
 
@@ -1036,13 +1098,21 @@ def clean(expunge):
     else:
         # We need to preserve the following
         # toolchain/setup/archive
+        # toolchain/setup/config_sub
+        # toolchain/setup/durations
+        # toolchain/setup/lock
         # toolchain/setup/patches
         # toolchain/setup/src
+        # toolchain/setup/state.db (but not what it knows about anything else)
+        store = StateStore(os.path.join(toolchain_root, 'setup', 'state.db'))
+
         for dir in os.listdir(toolchain_root):
             if dir.endswith('setup'):
                 for setup_dir in os.listdir(os.path.join(toolchain_root, dir)):
-                    if setup_dir not in ('archive', 'patches', 'src'):
+                    if setup_dir not in ('archive', 'config_sub', 'durations', 'lock', 'patches', 'src') \
+                       and not setup_dir.startswith('state.db'):
                         shutil.rmtree(os.path.join(toolchain_root, 'setup', setup_dir))
+                        store.remove(os.path.join(toolchain_root, 'setup', setup_dir))
             elif os.path.islink(os.path.join(toolchain_root, dir)):
                 os.unlink(os.path.join(toolchain_root, dir))
             elif os.path.isfile(os.path.join(toolchain_root, dir)):
@@ -1057,6 +1127,17 @@ def clean(expunge):
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--build', action='store_true', help='Build the Reel toolchains')
+parser.add_argument('--fetch', action='store_true', help='Download every archive the Reel toolchains need')
+parser.add_argument('--fetch-jobs', type=int, default=8, help='How many archives to download at once')
+parser.add_argument('--offline',
+                    action='store_true',
+                    help="Don't check if archives we have already downloaded have changed"
+)
+parser.add_argument('--plan',
+                    action='store_true',
+                    help='Show which libraries and phases a build would run, without building anything'
+)
+parser.add_argument('--json', action='store_true', help='Print the plan as JSON')
 parser.add_argument('--clean', action='store_true', help='Delete the Reel toolchains')
 parser.add_argument('--expunge',
                     action='store_true',
@@ -1068,6 +1149,25 @@ parser.add_argument('--force',
                     action='store_true',
                     help='Force installation. This will overwrite the specified install location. DATA WILL BE LOST!!'
 )
+parser.add_argument('--jobs',
+                    '-j',
+                    type=int,
+                    default=None,
+                    help='How many jobs to run at once across every build (defaults to the number of CPUs)'
+)
+parser.add_argument('--parallel-toolchains',
+                    action='store_true',
+                    help='Build toolchains that only depend on finished toolchains at the same time, each logging to '
+                    'its own toolchain.log'
+)
+parser.add_argument('--cache',
+                    default=None,
+                    help='A directory or http(s) URL to restore built libraries from and store them in'
+)
+parser.add_argument('--stream-extract',
+                    action='store_true',
+                    help='Extract archives while they are downloading instead of fetching them all before building'
+)
 parser.add_argument('--preserve-symlinks', action='store_true', help="Don't convert absolute symlinks to relative symlinks")
 args = parser.parse_args()
 
@@ -1085,6 +1185,14 @@ if __name__ == "__main__":
             if not args.preserve_symlinks:
                 clean_symlinks()
 
+        # Work out what a build would do
+        elif args.plan:
+            plan()
+
+        # Download everything we need to build Reel
+        elif args.fetch:
+            r.fetch(jobs=args.fetch_jobs, offline=args.offline)
+
         # Install Reel
         elif args.install:
             install(args.install_path, args.force)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import select
+import threading
+from contextlib import contextmanager
+
+
+class Jobserver:
+
+    def __init__(self, jobs):
+
+        # The total number of jobs we allow to run at once across every build
+        self.jobs = max(1, jobs)
+
+        # A GNU make jobserver is just a pipe full of tokens, every make gets one job for free and needs to take a token
+        # from the pipe for each extra job it runs. This pipe is inherited by everything we run (including other
+        # toolchain processes) so they all share the same budget. Every library build holds a token while it runs to pay
+        # for the job its tools get for free, so there is one token for every job
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_inheritable(self.read_fd, True)
+        os.set_inheritable(self.write_fd, True)
+        os.write(self.write_fd, b'+' * self.jobs)
+
+        # How many builds in this process are holding a token
+        self._lock = threading.Lock()
+        self.running = 0
+
+    @property
+    def fds(self):
+        return (self.read_fd, self.write_fd)
+
+    def env(self, env):
+
+        # Strip any parallelism flags we were given and tell make to use our jobserver instead
+        # --jobserver-fds is what make < 4.2 understands, newer makes read --jobserver-auth
+        flags = [f for f in env.get('MAKEFLAGS', '').split() if not f.startswith(('-j', '--jobserver'))]
+        flags = [
+            '-j',
+            '--jobserver-fds={},{}'.format(self.read_fd, self.write_fd),
+            '--jobserver-auth={},{}'.format(self.read_fd, self.write_fd),
+        ] + flags
+
+        env = dict(env)
+        env['MAKEFLAGS'] = ' '.join(flags)
+
+        return env
+
+    @contextmanager
+    def slot(self):
+        # Wait until there is a job free for us to build in
+        token = os.read(self.read_fd, 1)
+
+        with self._lock:
+            self.running += 1
+
+        try:
+            yield
+
+        finally:
+            with self._lock:
+                self.running -= 1
+
+            os.write(self.write_fd, token)
+
+    @contextmanager
+    def acquire(self):
+        # Take free tokens for tools that can't talk to a jobserver themselves (b2, ninja, etc), but no more than our share
+        # of them so we don't starve every make running beside us. We always get one job for free just like make does
+        with self._lock:
+            share = -(-self.jobs // max(1, self.running))
+
+        tokens = b''
+        while len(tokens) < share - 1 and select.select([self.read_fd], [], [], 0)[0]:
+            tokens += os.read(self.read_fd, 1)
+
+        try:
+            yield len(tokens) + 1
+
+        finally:
+            # Give our tokens back
+            if tokens:
+                os.write(self.write_fd, tokens)
@@ -1,14 +1,44 @@
 #!/usr/bin/env python3
 
+import os
+import time
 from termcolor import cprint
+from contextlib import ExitStack
 from collections import OrderedDict
 
-from .util import indent
+from .util import indent, lock, get_lock_path, get_status, update_status, get_url_status_path, get_fingerprint
 
 
 class Library:
 
-    def __init__(self, toolchain, phase_handlers, **kwargs):
+    # The phases which put our files into the prefix
+    INSTALL_PHASES = (
+        'pre_install',
+        'install',
+        'post_install',
+    )
+
+    # The phases which produce the shared source tree in sources_dir
+    SOURCE_PHASES = (
+        'pre_download',
+        'download',
+        'post_download',
+        'pre_extract',
+        'extract',
+        'post_extract',
+    )
+
+    # The parts of the toolchain that change what we build
+    TOOLCHAIN_INPUTS = (
+        'target_triple',
+        'parent_target_triple',
+        'prefix_dir',
+        'c_flags',
+        'cxx_flags',
+        'fc_flags',
+    )
+
+    def __init__(self, toolchain, phase_handlers, depends_on=None, **kwargs):
 
         # Our toolchain object
         self.toolchain = toolchain
@@ -16,6 +46,22 @@ class Library:
         # Our name
         self.name = kwargs.get('name')
 
+        # Where our source comes from
+        self.url = kwargs.get('url')
+
+        # Everything we were asked to build with
+        self.build_args = kwargs
+        self.phase_handlers = phase_handlers
+
+        # The key our installed files are cached under once we have been built
+        self.cache_key = None
+
+        # A hash of everything that went into our build, anything built on us is rebuilt when it changes
+        self.fingerprint = None
+
+        # The names of the libraries we need built before us (None means everything declared before us)
+        self.depends_on = list(depends_on) if depends_on is not None else None
+
         # Our phase handler instances
         self.handlers = []
 
@@ -38,17 +84,102 @@ class Library:
             ('post_install', None),
         ])
 
+        # Which handler instance provides each phase
+        self.phase_handler = {}
+
         # Get all our phase handlers and construct them
         # The last implementation of a phase is the one that gets used
         for ph in phase_handlers:
             handler = ph(**kwargs)
+            self.handlers.append(handler)
 
             # Bind in the functions provided
             for p in self.phase:
                 if hasattr(handler, p):
                     self.phase[p] = getattr(handler, p)
+                    self.phase_handler[p] = handler
+
+    def stages(self):
+
+        phases = [(p, f) for p, f in self.phase.items() if f is not None]
+
+        def leading(phases, test):
+            count = 0
+            while count < len(phases) and test(phases[count][0]):
+                count += 1
+            return phases[:count]
+
+        def io_bound(p):
+            return getattr(self.phase_handler[p], 'io_bound', False)
+
+        # Only I/O bound phases (downloading, extracting, patching) can be done ahead of time while other libraries are
+        # compiling, anything else (like a post_extract command) might need the libraries we depend on
+        prepare = leading(phases, io_bound)
+
+        # Whatever is left of making our source tree still changes it for everyone, but has to wait for our dependencies
+        source = leading(phases[len(prepare):], lambda p: p in Library.SOURCE_PHASES or io_bound(p))
+
+        return prepare, source, phases[len(prepare) + len(source):]
+
+    def prepare(self):
+
+        state = self.toolchain.state.copy()
+        prepare, source, _ = self.stages()
+        state['library_name'] = self.name
+        state['prepare_fingerprint'] = self.source_fingerprint(prepare + source, state)
+
+        return self.change_source(prepare, state)
+
+    def change_source(self, phases, state):
+
+        if not phases:
+            return state
+
+        # Most of the time our source is already exactly what we need, which we can check while others build from it
+        with self.source_lock(shared=True):
+            ready = self.ready(phases, state)
+
+        if ready is not None:
+            return ready
+
+        # Our downloaded and extracted source is shared with every toolchain, so only one of us may touch it at a time
+        with self.source_lock():
+            self.run(phases, state, self.prepare_fingerprint)
 
-    def build(self):
+        return state
+
+    def ready(self, phases, state):
+
+        recorded = get_status(self.phases_path())
+        state = dict(state)
+
+        # Replay what these phases did last time, if nothing they depend on has changed they don't need to run again
+        for p, _ in phases:
+            record = recorded.get(p)
+            if record is None:
+                return None
+
+            state['fingerprint'] = self.prepare_fingerprint(p, state)
+            if record['fingerprint'] != state['fingerprint']:
+                return None
+
+            state.update(record['state'])
+
+            # As long as what they made is still there
+            handler = self.phase_handler[p]
+            if hasattr(handler, 'current') and not handler.current(p, **state):
+                return None
+
+        return state
+
+    def source_lock(self, shared=False):
+        # Builds only read our source so any number of them can use it at once, but never while it is being prepared
+        if self.url is None:
+            return ExitStack()
+
+        return lock(get_lock_path(self.url, **self.toolchain.state), shared=shared)
+
+    def build(self, state=None, dependencies=()):
 
         cprint(
             'Building library {} for toolchain {}'.format(self.name, self.toolchain.state['toolchain_name']),
@@ -56,11 +187,275 @@ class Library:
             attrs=['bold']
         )
 
+        # Get our source ready unless it was done for us in the background
+        if state is None:
+            state = self.prepare()
+
+        # Then finish anything to do with our source that had to wait for our dependencies
+        _, source, build = self.stages()
+        state = self.change_source(source, state)
+
+        # Nobody may extract or patch our source again while we are building from it
+        with self.source_lock(shared=True):
+            cache = state.get('build_cache')
+
+            state['fingerprint'], self.fingerprint = self.seed(state, dependencies, self.parent_fingerprints())
+            update_status(self.fingerprints_path(), {self.name: self.fingerprint})
+
+            self.cache_key = cache.key(self, state, dependencies) if cache is not None else None
+            cache_status_path = os.path.join(state['status_dir'], 'build_cache.json')
+
+            if self.cache_key is None:
+                if cache is None:
+                    self.run(build, state, self.build_fingerprint)
+                    return
+
+                # Whatever build the cache last put in our prefix isn't there anymore
+                update_status(cache_status_path, {self.name: None})
+
+                # We aren't cached ourselves, but others are working out which files they installed from our prefix
+                self.run([p for p in build if p[0] not in Library.INSTALL_PHASES], state, self.build_fingerprint)
+                with self.toolchain.install_lock:
+                    self.run([p for p in build if p[0] in Library.INSTALL_PHASES], state, self.build_fingerprint)
+                return
+
+            # Our prefix already has exactly this build in it
+            if get_status(cache_status_path).get(self.name) == self.cache_key:
+                cprint(
+                    indent('{} is already installed from the build cache... Skipping...'.format(self.name), 8),
+                    'yellow',
+                    attrs=['bold']
+                )
+                return
+
+            if cache.restore(self.cache_key, state['prefix_dir']):
+                cprint(indent('Restored {} from the build cache'.format(self.name), 8), 'green', attrs=['bold'])
+
+            else:
+                install = [p for p in build if p[0] in Library.INSTALL_PHASES]
+                self.run([p for p in build if p[0] not in Library.INSTALL_PHASES], state, self.build_fingerprint)
+
+                # Nothing else may install into our prefix while we work out which files are ours
+                with self.toolchain.install_lock:
+                    before = cache.snapshot(state['prefix_dir'])
+                    self.run(install, state, self.build_fingerprint)
+                    files = cache.installed_files(before, cache.snapshot(state['prefix_dir']))
+
+                cache.save(self.cache_key, state['prefix_dir'], files)
+
+            update_status(cache_status_path, {self.name: self.cache_key})
+
+    def run(self, phases, state, fingerprint):
+
+        for p, f in phases:
+            # Phases record what they were run with so they can tell when they need to run again
+            state['fingerprint'] = fingerprint(p, state)
+
+            cprint(indent('Running phase {} for library {}'.format(p, self.name)), 'magenta', attrs=['bold'])
+            start = time.time()
+            new_state = f(**state)
+            self.record_duration(p, time.time() - start)
+            if new_state is not None:
+                state.update(new_state)
+
+            # Remember what we ran with and what came out, so we can work out what a build would do without running it
+            self.record_phase(p, state['fingerprint'], new_state)
+
+    def source_fingerprint(self, prepare, state):
+        # Everything we do to our source tree once it is extracted (like a patch). If one of these changes the tree is
+        # extracted again rather than patching on top of the old one
+        changes = [p for p, _ in prepare if p not in Library.SOURCE_PHASES or p == 'post_extract']
+        return get_fingerprint(self.url, [(p, self.inputs(p, state)) for p in changes])
+
+    def seed(self, state, dependencies, parent_fingerprints):
+        prepare, source, build = self.stages()
+
+        # Rebuild whenever our source, our toolchain or anything we were built against changes
+        seed = get_fingerprint(
+            [self.prepare_fingerprint(p, state) for p, _ in prepare + source],
+            {k: self.toolchain.state.get(k) for k in Library.TOOLCHAIN_INPUTS},
+            [d.fingerprint for d in dependencies],
+            parent_fingerprints,
+        )
+
+        # What we give to everything built on us covers every one of our phases
+        return seed, get_fingerprint(seed, [(p, self.inputs(p, state, resolve=True)) for p, _ in build])
+
+    def prepare_fingerprint(self, phase, state):
+        # A shared source tree can't depend on which toolchain got to it first, so these only build on the tree itself
+        return get_fingerprint(
+            state['prepare_fingerprint'],
+            state.get('archive_digest'),
+            state.get('source_fingerprint'),
+            phase,
+            self.inputs(phase, state),
+        )
+
+    def build_fingerprint(self, phase, state):
+        # Each phase is built on top of the ones before it, so a change reruns it and everything after it
+        return get_fingerprint(state['fingerprint'], phase, self.inputs(phase, state, resolve=True))
+
+    def inputs(self, phase, state, resolve=False):
+        handler = self.phase_handler[phase]
+
+        # Handlers can tell us what their phases depend on, otherwise we assume they depend on everything they hold
+        if hasattr(handler, 'inputs'):
+            inputs = handler.inputs(phase, **state)
+        else:
+            inputs = {k: v for k, v in vars(handler).items() if not k.startswith('_')}
+
+        return describe(inputs, state if resolve else None)
+
+    def fingerprints_path(self):
+        return os.path.join(self.toolchain.state['status_dir'], 'fingerprints.json')
+
+    def parent_fingerprints(self):
+        # Everything in our parent toolchain (such as the compiler) went into building us
+        parent = self.toolchain.parent_toolchain
+        if parent is None:
+            return None
+
+        fingerprints = get_status(os.path.join(parent.state['status_dir'], 'fingerprints.json'))
+        return sorted((l.name, fingerprints.get(l.name)) for l in parent.libraries)
+
+    def phases_path(self):
+        return os.path.join(self.toolchain.state['status_dir'], 'phases', '{}.json'.format(self.name))
+
+    def record_phase(self, phase, fingerprint, new_state):
+        # Only keep the state we can write down, which is all the paths and digests later phases need
+        new_state = {
+            k: v
+            for k, v in (new_state or {}).items()
+            if v is None or isinstance(v, (str, int, float, bool))
+        }
+        update_status(self.phases_path(), {phase: {'fingerprint': fingerprint, 'state': new_state}})
+
+    def plan(self, dependencies=(), parent_fingerprints=None):
+
         state = self.toolchain.state.copy()
+        prepare, source, build = self.stages()
+        recorded = get_status(self.phases_path())
+
+        phases = OrderedDict()
+
+        def replay(stage, fingerprint):
+            for p, _ in stage:
+                record = recorded.get(p)
+
+                if record is None:
+                    phases[p] = 'missing'
+
+                # Once something has to run everything after it runs too
+                elif any(v != 'up to date' for v in phases.values()):
+                    phases[p] = 'stale'
+
+                else:
+                    # Anything we can't work out (like a source tree that isn't there anymore) will have to be run
+                    try:
+                        state['fingerprint'] = fingerprint(p, state)
+                        current = record['fingerprint'] == state['fingerprint']
+                    except Exception:
+                        current = False
+
+                    phases[p] = 'up to date' if current else 'stale'
+                    state.update(record['state'])
+
+        state['prepare_fingerprint'] = self.source_fingerprint(prepare + source, state)
+        replay(prepare + source, self.prepare_fingerprint)
+
+        try:
+            state['fingerprint'], self.fingerprint = self.seed(state, dependencies, parent_fingerprints)
+        except Exception:
+            self.fingerprint = None
+
+        replay(build, self.build_fingerprint)
+
+        # If the build cache would put exactly this build in our prefix it doesn't matter what state the phases are in
+        cache = state.get('build_cache')
+        if cache is not None and self.fingerprint is not None:
+            try:
+                self.cache_key = cache.key(self, state, dependencies)
+            except Exception:
+                self.cache_key = None
+
+            installed = get_status(os.path.join(state['status_dir'], 'build_cache.json')).get(self.name)
+            if self.cache_key is not None and installed == self.cache_key:
+                for p, _ in build:
+                    phases[p] = 'up to date'
+
+        # How long the phases we have to run took last time, if we have ever run them
+        durations = self.durations()
+        remaining = sum(durations.get(p, 0) for p, v in phases.items() if v != 'up to date') if durations else None
+
+        if all(v == 'up to date' for v in phases.values()):
+            status = 'up to date'
+        elif all(v == 'missing' for v in phases.values()):
+            status = 'missing'
+        else:
+            status = 'stale'
+
+        return {
+            'name': self.name,
+            'status': status,
+            'phases': phases,
+            'remaining': remaining,
+            'fingerprint': self.fingerprint,
+        }
+
+    def durations_path(self):
+        # Kept outside the toolchain's working directory so a clean doesn't forget how long things take
+        return os.path.join(
+            self.toolchain.state['setup_dir'], 'durations', self.toolchain.state['toolchain_name'],
+            '{}.json'.format(self.name)
+        )
+
+    def durations(self):
+        return get_status(self.durations_path())
+
+    def record_duration(self, phase, duration):
+        # Phases with nothing to do finish almost instantly, don't let them overwrite a real measurement
+        if duration >= 1.0 or phase not in self.durations():
+            update_status(self.durations_path(), {phase: duration})
+
+    def estimated_duration(self):
+        durations = self.durations()
+        return sum(durations.values()) if durations else None
+
+    def archive_size(self):
+        if self.url is None:
+            return None
+
+        # Use the archive we prefetched, or the one we downloaded last time
+        archive = self.toolchain.state.get('archives', {}).get(self.url, {}).get('archive')
+        if archive is None:
+            archive = get_status(get_url_status_path(self.url, **self.toolchain.state)).get('archive')
+
+        return os.path.getsize(archive) if archive is not None and os.path.isfile(archive) else None
+
+
+def describe(value, state=None):
+
+    # Strings are described as they will be used, if we know enough to fill them in
+    if isinstance(value, str):
+        if state is not None:
+            try:
+                return value.format(**state)
+            except (KeyError, IndexError, ValueError, AttributeError):
+                pass
+        return value
+
+    elif isinstance(value, dict):
+        return {str(k): describe(v, state) for k, v in value.items()}
+
+    elif isinstance(value, (list, tuple, set)):
+        values = [describe(v, state) for v in value]
+        return sorted(values, key=str) if isinstance(value, set) else values
+
+    elif callable(value):
+        return '{}.{}'.format(getattr(value, '__module__', ''), getattr(value, '__qualname__', type(value).__name__))
+
+    elif value is None or isinstance(value, (bool, int, float)):
+        return value
 
-        for p, f in self.phase.items():
-            if f is not None:
-                cprint(indent('Running phase {} for library {}'.format(p, self.name)), 'magenta', attrs=['bold'])
-                new_state = f(**state)
-                if new_state is not None:
-                    state.update(new_state)
+    else:
+        return str(value)
@@ -5,13 +5,30 @@ import patch
 from functools import partial
 from termcolor import cprint
 
-from .util import indent, get_status, update_status, is_sequence
+from .download import HTTPClient
+from .util import indent, is_complete, set_complete, is_sequence, lock, get_lock_path, get_file_digest
 
 
 class Patch:
 
     class PatchSet:
 
+        # Patching only touches the source tree so it can happen ahead of time
+        io_bound = True
+
+        def __init__(self, commands, build_args):
+            self.commands = commands
+            self.build_args = build_args
+
+        def inputs(self, phase, **state):
+            patch_uris = self.commands[phase] if is_sequence(self.commands[phase]) else [self.commands[phase]]
+
+            # Patches from files change when the file does
+            return [
+                [get_file_digest(p) if os.path.isfile(p) else p for p in patch_uris],
+                self.build_args.get('patch_root'),
+            ]
+
         def execute(self, phase, patch_uri, build_args, **state):
 
             # Build our environment variables
@@ -31,88 +48,96 @@ class Patch:
             else:
                 raise Exception('Unable to apply a patch without a source directory')
 
-            # Load the status file
-            status = get_status(status_path)
-
-            if phase not in status or not status[phase]:
-                os.makedirs(logs_path, exist_ok=True)
-
-                with open(os.path.join(logs_path, '{}_{}.log'.format(base_src, phase)), 'w') as logfile:
-                    if is_sequence(patch_uri):
-                        patch_uris = patch_uri
-                    else:
-                        patch_uris = [patch_uri]
-
-                    errors = False
-                    for patch_uri in patch_uris:
-                        try:
-                            if patch_uri.startswith(('http', 'ftp')):
-                                cprint(
-                                    indent('Applying patch from URL to "{}"'.format(base_src), 8),
-                                    'white',
-                                    attrs=['bold']
-                                )
-                                logfile.write('Applying patch from URL "{}" to "{}"\n'.format(patch_uri, base_src))
-                                pset = patch.fromurl(patch_uri)
-                            elif os.path.exists(patch_uri):
+            # The patches directory is shared between toolchains, so make sure only one of us patches at a time
+            with lock(get_lock_path(status_path, **state)):
+                if not is_complete(status_path, phase, **state):
+                    os.makedirs(logs_path, exist_ok=True)
+
+                    with open(os.path.join(logs_path, '{}_{}.log'.format(base_src, phase)), 'w') as logfile:
+                        if is_sequence(patch_uri):
+                            patch_uris = patch_uri
+                        else:
+                            patch_uris = [patch_uri]
+
+                        errors = False
+                        for patch_uri in patch_uris:
+                            try:
+                                if patch_uri.startswith(('http', 'ftp')):
+                                    cprint(
+                                        indent('Applying patch from URL to "{}"'.format(base_src), 8),
+                                        'white',
+                                        attrs=['bold']
+                                    )
+                                    logfile.write('Applying patch from URL "{}" to "{}"\n'.format(patch_uri, base_src))
+
+                                    # FTP isn't something our HTTP client can do
+                                    if patch_uri.startswith('ftp'):
+                                        pset = patch.fromurl(patch_uri)
+                                    else:
+                                        req = HTTPClient.get(patch_uri)
+                                        req.raise_for_status()
+                                        pset = patch.fromstring(req.content)
+                                elif os.path.exists(patch_uri):
+                                    cprint(
+                                        indent('Applying patch from local file to "{}"'.format(base_src), 8),
+                                        'white',
+                                        attrs=['bold']
+                                    )
+                                    logfile.write(
+                                        'Applying patch from local file "{}" to "{}"\n'.format(patch_uri, base_src)
+                                    )
+                                    pset = patch.fromfile(patch_uri)
+                                else:
+                                    cprint(
+                                        indent('Applying patch from string to "{}"'.format(base_src), 8),
+                                        'white',
+                                        attrs=['bold']
+                                    )
+                                    logfile.write(
+                                        'Applying patch from string "{}" to "{}"\n'.format(patch_uri, base_src)
+                                    )
+
+                                    # Strings have to be bytes encoded
+                                    pset = patch.fromstring(patch_uri.encode('utf-8'))
+
+                            except:
+                                pset = False
+                                pass
+
+                            if not pset:
+                                errors = True
+                                cprint(indent('Failed to load patch "{}"'.format(patch_uri), 8), 'red', attrs=['bold'])
+
+                            root_folder = build_args.get('patch_root', src_path)
+                            patch.streamhandler = patch.logging.StreamHandler(stream=logfile)
+                            patch.setdebug()
+                            if pset and not pset.apply(root=root_folder):
+                                errors = True
                                 cprint(
-                                    indent('Applying patch from local file to "{}"'.format(base_src), 8),
-                                    'white',
+                                    indent('Failed to apply patch "{}" to "{}"'.format(patch_uri, base_src), 8),
+                                    'red',
                                     attrs=['bold']
                                 )
-                                logfile.write(
-                                    'Applying patch from local file "{}" to "{}"\n'.format(patch_uri, base_src)
-                                )
-                                pset = patch.fromfile(patch_uri)
-                            else:
-                                cprint(
-                                    indent('Applying patch from string to "{}"'.format(base_src), 8),
-                                    'white',
-                                    attrs=['bold']
-                                )
-                                logfile.write('Applying patch from string "{}" to "{}"\n'.format(patch_uri, base_src))
-
-                                # Strings have to be bytes encoded
-                                pset = patch.fromstring(patch_uri.encode('utf-8'))
 
-                        except:
-                            pset = False
-                            pass
+                        if errors:
+                            raise Exception('{} step for {} failed to apply patches'.format(phase, base_src))
 
-                        if not pset:
-                            errors = True
-                            cprint(indent('Failed to load patch "{}"'.format(patch_uri), 8), 'red', attrs=['bold'])
+                        else:
+                            set_complete(status_path, phase, **state)
 
-                        root_folder = build_args.get('patch_root', src_path)
-                        patch.streamhandler = patch.logging.StreamHandler(stream=logfile)
-                        patch.setdebug()
-                        if pset and not pset.apply(root=root_folder):
-                            errors = True
-                            cprint(
-                                indent('Failed to apply patch "{}" to "{}"'.format(patch_uri, base_src), 8),
-                                'red',
-                                attrs=['bold']
-                            )
-
-                    if errors:
-                        raise Exception('{} step for {} failed to apply patches'.format(phase, base_src))
-
-                    else:
-                        status = update_status(status_path, {phase: True})
-
-            else:
-                cprint(
-                    indent('{} step for {} complete... Skipping...'.format(phase, base_src), 8),
-                    'yellow',
-                    attrs=['bold']
-                )
+                else:
+                    cprint(
+                        indent('{} step for {} complete... Skipping...'.format(phase, base_src), 8),
+                        'yellow',
+                        attrs=['bold']
+                    )
 
     def __init__(self, **commands):
         self.commands = commands
 
     def __call__(self, **build_args):
 
-        v = Patch.PatchSet()
+        v = Patch.PatchSet(self.commands, build_args)
 
         for k in self.commands:
             setattr(v, k, partial(v.execute, k, self.commands[k], build_args))
@@ -7,13 +7,20 @@ from subprocess import Popen
 from functools import partial
 from termcolor import cprint
 
-from .util import indent, get_status, update_status
+from .util import indent, is_complete, set_complete, get_env_changes
 
 
 class Python:
 
     class Command:
 
+        def __init__(self, commands, build_args):
+            self.commands = commands
+            self.build_args = build_args
+
+        def inputs(self, phase, **state):
+            return [self.commands[phase], get_env_changes(self.build_args.get('env', {}))]
+
         def execute(self, phase, command, build_args, **state):
 
             # Build our environment variables
@@ -35,10 +42,7 @@ class Python:
                 status_path = os.path.join(state['status_dir'], '{}.json'.format(base_src))
                 logs_path = os.path.join(state['logs_dir'], base_src)
 
-            # Load the status file
-            status = get_status(status_path)
-
-            if phase not in status or not status[phase]:
+            if not is_complete(status_path, phase, **state):
                 os.makedirs(logs_path, exist_ok=True)
 
                 with open(os.path.join(logs_path, '{}_{}.log'.format(base_src, phase)), 'w') as logfile:
@@ -53,7 +57,7 @@ class Python:
                         raise Exception('Failed to run phase {}'.format(phase))
 
                     else:
-                        status = update_status(status_path, {phase: True})
+                        set_complete(status_path, phase, **state)
                         return new_state
 
             else:
@@ -68,7 +72,7 @@ class Python:
 
     def __call__(self, **build_args):
 
-        v = Python.Command()
+        v = Python.Command(self.commands, build_args)
 
         for k in self.commands:
             setattr(v, k, partial(v.execute, k, self.commands[k], build_args))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Scheduler:
+
+    # A rough guess at how long a library takes to build from the size of its archive (about 20 seconds a megabyte)
+    SECONDS_PER_BYTE = 20.0 / (1024 * 1024)
+
+    def __init__(self, libraries, jobs=1, prepare_jobs=4):
+
+        # The libraries to build in the order they were declared
+        self.libraries = libraries
+
+        # How many libraries we are allowed to build at once
+        self.jobs = max(1, jobs)
+
+        # How many libraries we download, extract and patch ahead of time at once
+        self.prepare_jobs = max(1, prepare_jobs)
+
+        # Work out what each library has to wait for
+        self.dependencies = OrderedDict()
+
+        for i, l in enumerate(self.libraries):
+            earlier = self.libraries[:i]
+
+            # Libraries that don't declare their dependencies keep the old behaviour and wait for everything before
+            # them. Everything after them waits for them too, so each one is a barrier nothing is built across
+            if l.depends_on is None:
+                self.dependencies[l] = list(earlier)
+
+            else:
+                # Still wait for every library before us that didn't declare its dependencies, so anything the
+                # toolchain relies on implicitly (binutils, gcc, musl etc) is always available
+                deps = [e for e in earlier if e.depends_on is None]
+
+                for name in l.depends_on:
+                    # Use the closest library with this name that was declared before us
+                    matches = [e for e in earlier if e.name == name]
+
+                    if not matches:
+                        raise Exception(
+                            'Library {} depends on {} which has not been declared before it'.format(l.name, name)
+                        )
+
+                    if matches[-1] not in deps:
+                        deps.append(matches[-1])
+
+                self.dependencies[l] = deps
+
+        # Work out which libraries hold up the most work so we can start them first
+        self.priority = self.critical_path()
+
+    def critical_path(self):
+
+        # How long we think each library takes from the last time we built it
+        costs = {l: l.estimated_duration() for l in self.libraries}
+        sizes = {l: l.archive_size() for l in self.libraries}
+
+        # For libraries we have never built, guess from how big their archive is compared to the ones we have built
+        known = [(costs[l], sizes[l]) for l in self.libraries if costs[l] is not None and sizes[l]]
+        rate = sum(k[0] for k in known) / sum(k[1] for k in known) if known else Scheduler.SECONDS_PER_BYTE
+
+        for l in self.libraries:
+            if costs[l] is None:
+                costs[l] = sizes[l] * rate if sizes[l] else 0
+
+        # Dependents are always declared after their dependencies, so walk backwards adding up the longest chain
+        dependents = {l: [] for l in self.libraries}
+        for l, deps in self.dependencies.items():
+            for d in deps:
+                dependents[d].append(l)
+
+        priority = {}
+        for l in reversed(self.libraries):
+            priority[l] = costs[l] + max((priority[d] for d in dependents[l]), default=0)
+
+        return priority
+
+    def ready(self, pending, done):
+        # Ready libraries with the longest chain of work behind them go first, otherwise in declaration order
+        ready = [l for l in pending if all(d in done for d in self.dependencies[l])]
+        return sorted(ready, key=lambda l: -self.priority[l])
+
+    def build(self, library, prepared):
+        # Wait for our source to be ready, then compile using one of the jobs every build shares
+        state = prepared.result()
+
+        with library.toolchain.state['jobserver'].slot():
+            library.build(state, self.dependencies[library])
+
+    def run(self):
+
+        pending = list(self.libraries)
+        running = {}
+        done = set()
+
+        with ThreadPoolExecutor(max_workers=self.prepare_jobs) as prepare_pool, \
+             ThreadPoolExecutor(max_workers=self.jobs) as pool:
+
+            # Start getting sources ready in the background, in the order they are going to be needed
+            prepared = OrderedDict((l, prepare_pool.submit(l.prepare)) for l in self.libraries)
+
+            try:
+                while pending or running:
+
+                    # Start everything that is ready to go, most important first
+                    for l in self.ready(pending, done)[:self.jobs - len(running)]:
+                        pending.remove(l)
+                        running[pool.submit(self.build, l, prepared[l])] = l
+
+                    if not running:
+                        raise Exception('Unable to schedule {}'.format(', '.join(l.name for l in pending)))
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                    for f in finished:
+                        l = running.pop(f)
+
+                        # If a library failed stop scheduling, the executor will wait for the running builds to finish
+                        if f.exception() is not None:
+                            raise f.exception()
+
+                        done.add(l)
+
+            finally:
+                # Don't bother preparing anything we are never going to build
+                for f in prepared.values():
+                    f.cancel()
@@ -3,15 +3,23 @@
 import os
 from subprocess import Popen
 from functools import partial
+from contextlib import ExitStack
 from termcolor import cprint
 
-from .util import indent, get_status, update_status
+from .util import indent, is_complete, set_complete, get_env_changes
 
 
 class Shell:
 
     class Command:
 
+        def __init__(self, commands, build_args):
+            self.commands = commands
+            self.build_args = build_args
+
+        def inputs(self, phase, **state):
+            return [self.commands[phase], get_env_changes(self.build_args.get('env', {}))]
+
         def execute(self, phase, command, build_args, **state):
 
             # Build our environment variables
@@ -33,19 +41,27 @@ class Shell:
                 status_path = os.path.join(state['status_dir'], '{}.json'.format(base_src))
                 logs_path = os.path.join(state['logs_dir'], base_src)
 
-            # Load the status file
-            status = get_status(status_path)
-
-            if phase not in status or not status[phase]:
+            if not is_complete(status_path, phase, **state):
                 os.makedirs(logs_path, exist_ok=True)
 
-                with open(os.path.join(logs_path, '{}_{}.log'.format(base_src, phase)), 'w') as logfile:
-                    print(indent(' $ {}'.format(command.format(**state)), 8))
+                with open(os.path.join(logs_path, '{}_{}.log'.format(base_src, phase)),
+                          'w') as logfile, ExitStack() as stack:
+
+                    # Commands that ask for {jobs} get as many jobs as the jobserver can spare
+                    jobs = stack.enter_context(state['jobserver'].acquire()) if '{jobs}' in command else 1
+
+                    env = {k: v.format(**state) for (k, v) in env.items()}
+
+                    # Any make run while building shares our jobserver
+                    if phase.endswith('build'):
+                        env = state['jobserver'].env(env)
+
+                    print(indent(' $ {}'.format(command.format(jobs=jobs, **state)), 8))
                     process = Popen(
-                        args=command.format(**state),
+                        args=command.format(jobs=jobs, **state),
                         shell=True,
-                        env={k: v.format(**state)
-                             for (k, v) in env.items()},
+                        env=env,
+                        pass_fds=state['jobserver'].fds,
                         stdout=logfile,
                         stderr=logfile
                     )
@@ -54,7 +70,7 @@ class Shell:
                         raise Exception('Failed to run phase {}'.format(phase))
 
                     else:
-                        status = update_status(status_path, {phase: True})
+                        set_complete(status_path, phase, **state)
 
             else:
                 cprint(
@@ -68,7 +84,7 @@ class Shell:
 
     def __call__(self, **build_args):
 
-        v = Shell.Command()
+        v = Shell.Command(self.commands, build_args)
 
         for k in self.commands:
             setattr(v, k, partial(v.execute, k, self.commands[k], build_args))
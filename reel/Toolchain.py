@@ -4,6 +4,7 @@ import os
 import re
 import sys
 import subprocess
+import threading
 from termcolor import cprint
 import multiprocessing
 
@@ -11,11 +12,13 @@ from .build import SmartBuild
 from .download import SmartDownload
 from .extract import SmartExtract
 from .Library import Library
+from .Scheduler import Scheduler
+from .Jobserver import Jobserver
 from .patch import UpdateConfigSub
 from .Patch import Patch
 from .Shell import Shell
 from .Python import Python
-from .util import dedent
+from .util import dedent, StateStore
 
 
 class Toolchain:
@@ -72,8 +75,14 @@ class Toolchain:
         self.logs_dir = os.path.join(self.working_dir, 'log')
         self.status_dir = os.path.join(self.working_dir, 'status')
 
+        # Every toolchain keeps its build state in the one database
+        StateStore.open(os.path.join(self.setup_dir, 'state.db'))
+
         self.libraries = []
 
+        # Held while a library installs when we need to know exactly which files it installed
+        self.install_lock = threading.Lock()
+
         self.state = {
             'toolchain_name': self.name if self.name else 'root',
             'arch': self.arch,
@@ -320,7 +329,7 @@ class Toolchain:
             )
 
     # Build a tool we can run (Use our state but parents env)
-    def add_tool(self, phases=None, **kwargs):
+    def add_tool(self, phases=None, depends_on=None, **kwargs):
 
         # Update our own env with one if it's provided
         env = self.parent_toolchain.env.copy()
@@ -333,10 +342,10 @@ class Toolchain:
         if phases is not None:
             default_phases.extend(phases)
 
-        self.libraries.append(Library(self, default_phases, **kwargs))
+        self.libraries.append(Library(self, default_phases, depends_on=depends_on, **kwargs))
 
     # Build a library using our toolchain
-    def add_library(self, phases=None, **kwargs):
+    def add_library(self, phases=None, depends_on=None, **kwargs):
 
         # Update our own env with one if it's provided
         env = self.env.copy()
@@ -349,20 +358,21 @@ class Toolchain:
         if phases is not None:
             default_phases.extend(phases)
 
-        self.libraries.append(Library(self, default_phases, **kwargs))
+        self.libraries.append(Library(self, default_phases, depends_on=depends_on, **kwargs))
 
     def install_compression_libraries(self, **kwargs):
 
         if kwargs.get('xz', False):
-            self.add_library(name='xz', url='https://tukaani.org/xz/xz-5.2.3.tar.xz')
+            self.add_library(name='xz', url='https://tukaani.org/xz/xz-5.2.3.tar.xz', depends_on=[])
 
         if kwargs.get('bzip2', False):
-            self.add_library(name='bzip2', url='https://github.com/Bidski/bzip2/archive/master.tar.gz')
+            self.add_library(name='bzip2', url='https://github.com/Bidski/bzip2/archive/master.tar.gz', depends_on=[])
 
         if kwargs.get('zlib', False):
             self.add_library(
                 name='zlib',
                 url='http://www.zlib.net/zlib-1.2.11.tar.gz',
+                depends_on=[],
                 configure_args={
                     # zlib has a special configure which doesn't understand the usual options
                     '--host': None,
@@ -447,7 +457,8 @@ class Toolchain:
             self.add_library(
                 name='xorg-protocol-header-{}'.format(proto[0]),
                 url='https://www.x.org/pub/individual/proto/{}-{}.tar.bz2'.format(*proto),
-                phases=[UpdateConfigSub]
+                phases=[UpdateConfigSub],
+                depends_on=['util-macros']
             )
 
         self.add_library(name='Xdmcp', url='https://www.x.org/pub/individual/lib/libXdmcp-1.1.2.tar.bz2')
@@ -592,7 +603,12 @@ class Toolchain:
             install_targets=['headers_install']
         )
 
-    def build(self):
+    def build(self, jobs=None, jobserver=None):
+
+        jobs = jobs if jobs is not None else self.state['cpu_count']
+
+        # Share the jobserver we were given, or make our own if we are being built alone
+        self.state['jobserver'] = jobserver if jobserver is not None else Jobserver(jobs)
 
         # Make our directories if they do not already exist
         os.makedirs(self.prefix_dir, exist_ok=True)
@@ -631,9 +647,15 @@ class Toolchain:
         cprint('#' * (max_len + 4), 'red', attrs=['bold'])
         cprint('')
 
-        # Build all our libraries
-        for l in self.libraries:
-            l.build()
+        # Build all our libraries, running independent ones side by side
+        Scheduler(self.libraries, jobs).run()
+
+    def plan(self, parent_fingerprints=None):
+
+        # Each library waits on exactly what it would wait on in a real build
+        dependencies = Scheduler(self.libraries).dependencies
+
+        return [l.plan(dependencies[l], parent_fingerprints) for l in self.libraries]
 
 def binutils_post_install(env, log_file, **state):
     for f in ['addr2line', 'ar', 'as', 'c++filt', 'elfedit', 'gprof', 'ld', 'ld.bfd', 'nm', 'objcopy', 'objdump',
@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import platform
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing.connection import wait
+from termcolor import cprint
+from tqdm import tqdm
+
+from .cache import BuildCache
+from .download import HTTPDownload
 
 from .Patch import Patch
 from .patch import UpdateConfigSub
 from .Python import Python
 from .Shell import Shell
 from .Toolchain import Toolchain
-from .util import dedent
+from .Jobserver import Jobserver
+from .util import dedent, indent, lock, get_lock_path, clone_tree
 
 
 class Reel:
@@ -128,10 +139,7 @@ class Reel:
             name='ninja',
             url='https://github.com/ninja-build/ninja/archive/v1.8.2.tar.gz',
             phases=[
-                Shell(
-                    configure=
-                    'mkdir -p {builds_dir}/$(basename {source}) && cp -rv {source}/* {builds_dir}/$(basename {source})'
-                ),
+                Python(configure=clone_source),
                 Shell(build='cd {builds_dir}/$(basename {source}) && ./configure.py --bootstrap'),
                 Shell(install='cd {builds_dir}/$(basename {source}) && cp -v ninja {prefix_dir}/bin')
             ],
@@ -199,7 +207,7 @@ class Reel:
                     '    --no-qt-gui'
                     '    --system-zlib'
                     '    --system-curl'
-                    '    --parallel={cpu_count}'
+                    '    --parallel={jobs}'
                 ),
                 Shell(build='cd {builds_dir}/$(basename {source})'
                       ' && make'),
@@ -278,7 +286,204 @@ class Reel:
     def install_linux_headers(self, **kwargs):
         kwargs.get('toolchain', self.toolchain).install_linux_headers(**kwargs)
 
-    def build(self):
-        # Build our toolchains
+    def fetch(self, jobs=8, offline=False):
+
+        # Offline we trust every archive we already have and only download the ones we are missing
+        for t in self.toolchains:
+            t.state['offline'] = offline
+
+        # Work out every archive we need, the same archive is often used by several toolchains
+        urls = OrderedDict()
+        for t in self.toolchains:
+            for l in t.libraries:
+                if l.url is not None and l.url.startswith(('http://', 'https://')):
+                    # Verify against the checksum if any of the libraries using this archive gave one
+                    if l.url not in urls or urls[l.url][1] is None:
+                        urls[l.url] = (t, l.build_args.get('sha256'))
+
+        cprint('Fetching {} archives'.format(len(urls)), 'cyan', attrs=['bold'])
+
+        archives = {}
+        failed = []
+
+        # Download them all at once, reporting to one progress bar
+        with tqdm(total=0, unit='B', unit_scale=True) as progress, ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                pool.submit(fetch_archive, url, sha256, t, progress): url
+                for url, (t, sha256) in urls.items()
+            }
+
+            for f in as_completed(futures):
+                url = futures[f]
+
+                if f.exception() is not None:
+                    failed.append(url)
+                    cprint(indent('Failed to fetch {}: {}'.format(url, f.exception()), 8), 'red', attrs=['bold'])
+                else:
+                    archives[url] = f.result()
+
+                progress.set_postfix_str('{}/{} archives'.format(len(archives) + len(failed), len(urls)))
+
+        # Anything that failed will be tried again (and fail loudly) when its library is built
+        if failed:
+            cprint('Failed to fetch {} archives'.format(len(failed)), 'red', attrs=['bold'])
+
+        return archives
+
+    def plan(self, cache=None):
+
+        # Look in the same build cache a build would use
+        if cache is not None:
+            for t in self.toolchains:
+                t.state['build_cache'] = BuildCache(cache)
+
+        toolchains = []
+        for t in self.toolchains:
+
+            # Our parent's libraries are planned before us, so use what they will be rather than what they were
+            parent = None
+            if t.parent_toolchain is not None:
+                fingerprints = {l.name: l.fingerprint for l in t.parent_toolchain.libraries}
+                parent = sorted((l.name, fingerprints[l.name]) for l in t.parent_toolchain.libraries)
+
+            libraries = t.plan(parent)
+            toolchains.append({
+                'name': t.state['toolchain_name'],
+                'up_to_date': all(l['status'] == 'up to date' for l in libraries),
+                'remaining': sum(l['remaining'] or 0 for l in libraries),
+                'libraries': libraries,
+            })
+
+        return {
+            'up_to_date': all(t['up_to_date'] for t in toolchains),
+            'remaining': sum(t['remaining'] for t in toolchains),
+            'toolchains': toolchains,
+        }
+
+    def build(
+        self, jobs=None, parallel=False, prefetch=True, fetch_jobs=8, cache=None, offline=False, stream_extract=False
+    ):
+
         for t in self.toolchains:
-            t.build()
+            t.state['offline'] = offline
+
+            # Extract archives as they download, this happens as each library is prepared so it replaces prefetching
+            t.state['stream_extract'] = stream_extract
+
+        # Restore libraries we have built before from the build cache rather than building them again
+        if cache is not None:
+            for t in self.toolchains:
+                t.state['build_cache'] = BuildCache(cache)
+
+        # Download everything up front so we aren't waiting on the network in between builds
+        if prefetch and not stream_extract:
+            archives = self.fetch(jobs=fetch_jobs, offline=offline)
+
+            for t in self.toolchains:
+                t.state['archives'] = archives
+
+        # Every build in every toolchain shares the one job budget
+        jobs = jobs if jobs is not None else multiprocessing.cpu_count()
+        jobserver = Jobserver(jobs)
+
+        # Build our toolchains one after the other
+        if not parallel:
+            for t in self.toolchains:
+                t.build(jobs=jobs, jobserver=jobserver)
+            return
+
+        # Otherwise build every toolchain whose parent is done in its own process
+        context = multiprocessing.get_context('fork')
+        pending = list(self.toolchains)
+        running = {}
+        failed = []
+
+        while pending or running:
+            ready = [t for t in pending if t.parent_toolchain not in pending + list(running.values())]
+
+            if not failed:
+                # If there is only one thing we can do, do it here so we can see what is going on
+                if len(ready) == 1 and not running:
+                    pending.remove(ready[0])
+                    ready[0].build(jobs=jobs, jobserver=jobserver)
+                    continue
+
+                for t in ready:
+                    log_file = os.path.join(t.logs_dir, 'toolchain.log')
+                    cprint(
+                        'Building toolchain {} in the background, logging to {}'.format(
+                            t.state['toolchain_name'], log_file
+                        ),
+                        'cyan',
+                        attrs=['bold']
+                    )
+
+                    # Flush our output so the child doesn't inherit anything we have buffered
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+
+                    process = context.Process(target=build_toolchain, args=(t, log_file, jobs, jobserver))
+                    process.start()
+
+                    pending.remove(t)
+                    running[process] = t
+
+            # Nothing left to wait on
+            if not running:
+                break
+
+            for sentinel in wait([p.sentinel for p in running]):
+                process = [p for p in running if p.sentinel == sentinel][0]
+                t = running.pop(process)
+                process.join()
+
+                if process.exitcode != 0:
+                    failed.append(t)
+                    cprint(
+                        'Failed to build toolchain {}, see {}'.format(
+                            t.state['toolchain_name'], os.path.join(t.logs_dir, 'toolchain.log')
+                        ),
+                        'red',
+                        attrs=['bold']
+                    )
+                else:
+                    cprint('Finished building toolchain {}'.format(t.state['toolchain_name']), 'green', attrs=['bold'])
+
+        if failed:
+            raise Exception(
+                'Failed to build toolchains {}'.format(', '.join(t.state['toolchain_name'] for t in failed))
+            )
+
+
+def fetch_archive(url, sha256, toolchain, progress):
+
+    state = toolchain.state.copy()
+    state['download_progress'] = progress
+
+    os.makedirs(state['archives_dir'], exist_ok=True)
+
+    # Use the same lock as the library builds so we never download the same archive twice at once
+    with lock(get_lock_path(url, **state)):
+        return HTTPDownload(url=url, sha256=sha256).download(**state)
+
+
+def clone_source(env, log_file, **state):
+
+    # Give libraries that build in their source tree a clone of it to themselves
+    dest = os.path.join(state['builds_dir'], os.path.basename(state['source']))
+
+    with state['jobserver'].acquire() as jobs:
+        count = clone_tree(state['source'], dest, jobs)
+
+    log_file.write('Cloned {} files from {} to {}\n'.format(count, state['source'], dest))
+
+
+def build_toolchain(toolchain, log_file, jobs, jobserver):
+
+    # Send everything we (and anything we run) print to our own log file
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    with open(log_file, 'w') as f:
+        os.dup2(f.fileno(), sys.stdout.fileno())
+        os.dup2(f.fileno(), sys.stderr.fileno())
+
+    toolchain.build(jobs=jobs, jobserver=jobserver)
@@ -1,14 +1,35 @@
 #!/usr/bin/env python3
 
 import os
+import re
 from subprocess import Popen
 from termcolor import cprint
 
-from ..util import get_status, update_status, indent, get_paths
+from ..util import is_complete, set_complete, get_env_changes, clone_tree, indent, get_paths
+from ..util import get_status, update_status, get_fingerprint, lock, get_lock_path
 
 
 class AutotoolsBuild:
 
+    # The environment that changes what configure finds, builds that set these differently can't share answers
+    CACHE_ENV = ('CC', 'CPP', 'CXX', 'CXXCPP', 'CFLAGS', 'CPPFLAGS', 'CXXFLAGS', 'LDFLAGS', 'LIBS')
+
+    # Only answers about the compiler and the target itself are shared, anything else (like whether a header or function
+    # is there) can depend on a library's own flags or on what has been installed so far
+    CACHE_SHARED = (
+        'ac_cv_build',
+        'ac_cv_host',
+        'ac_cv_target',
+        'ac_cv_objext',
+        'ac_cv_exeext',
+        'ac_cv_c_',
+        'ac_cv_cxx_',
+        'ac_cv_sizeof_',
+        'ac_cv_alignof_',
+        'ac_cv_type_',
+        'ac_cv_sys_',
+    )
+
     def __init__(self, **build_args):
 
         # Set our default configuration arguments
@@ -39,6 +60,9 @@ class AutotoolsBuild:
         # Because asshats
         self.in_source_build = build_args.get('in_source_build', False)
 
+        # Share what configure finds out about our compiler with every other library in the toolchain
+        self.configure_cache = build_args.get('configure_cache', True)
+
         # Build our environment variables
         self.env = dict(os.environ)
 
@@ -46,30 +70,35 @@ class AutotoolsBuild:
         if 'env' in build_args:
             self.env.update(build_args['env'])
 
+    def inputs(self, phase, **state):
+        # What each of our phases is run with, anything else we hold doesn't change what they do
+        env = get_env_changes(self.env)
+        return {
+            'configure': [self.configure_args, self.src_dir, self.in_source_build, env],
+            'build': [self.build_args, self.build_targets, env],
+            'install': [self.install_args, self.install_targets, env],
+        }.get(phase)
+
     def autogen(self, **state):
         # Work out our real full paths
-        src_path, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
-
-        if os.path.isfile(os.path.join(src_path, 'autogen.sh')):
-            # Load the status file.
-            status = get_status(status_path)
+        _, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
 
-            if 'autogen_pre_configure' not in status or not status['autogen_pre_configure']:
-                # Make our build directory and log directory
-                os.makedirs(build_path, exist_ok=True)
+        # This runs in our own copy of the source, the shared one belongs to every toolchain
+        if os.path.isfile(os.path.join(build_path, 'autogen.sh')):
+            if not is_complete(status_path, 'autogen_pre_configure', **state):
                 os.makedirs(logs_path, exist_ok=True)
 
-                # Open a log file and run configure
+                # Open a log file and run autogen
                 with open(os.path.join(logs_path, '{}_autogen_pre_configure.log'.format(base_src)), 'w') as logfile:
-                    self.env.update({'NOCONFIGURE': '1'})
-                    cmd = os.path.abspath(os.path.join(src_path, 'autogen.sh'))
+                    env = dict(self.env, NOCONFIGURE='1')
+                    cmd = os.path.abspath(os.path.join(build_path, 'autogen.sh'))
                     print(indent(' $ {}'.format(cmd), 8))
                     process = Popen(
                         args=cmd,
                         shell=True,
-                        cwd=os.path.abspath(src_path),
+                        cwd=os.path.abspath(build_path),
                         env={k: v.format(**state)
-                             for k, v in self.env.items()},
+                             for k, v in env.items()},
                         stdout=logfile,
                         stderr=logfile
                     )
@@ -77,7 +106,7 @@ class AutotoolsBuild:
                         raise Exception('Failed to the autogen pre-configure step for {}'.format(base_src))
 
                     else:
-                        status = update_status(status_path, {'autogen_pre_configure': True})
+                        set_complete(status_path, 'autogen_pre_configure', **state)
 
             else:
                 cprint(
@@ -93,9 +122,9 @@ class AutotoolsBuild:
         # Work out our real full paths
         src_path, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
 
-        # Generate configure file if it does not already exist
-        if not os.path.isfile(os.path.join(src_path, self.src_dir, 'configure')):
-            self.autogen(**state)
+        # Without a configure script we have to generate one, which we can only do in our own copy of the source
+        autogen = not os.path.isfile(os.path.join(src_path, self.src_dir, 'configure'))
+        in_source_build = self.in_source_build or autogen
 
         # Apply our state
         args = [
@@ -104,59 +133,77 @@ class AutotoolsBuild:
             if v is not None
         ]
 
-        # Load the status file
-        status = get_status(status_path)
-
-        if 'configure' not in status or not status['configure']:
+        if not is_complete(status_path, 'configure', **state):
             # Make our build directory and log directory
             os.makedirs(build_path, exist_ok=True)
             os.makedirs(logs_path, exist_ok=True)
 
-            if 'clone' not in status or not status['clone']:
-                if self.in_source_build:
-                    with open(os.path.join(logs_path, '{}_clone.log'.format(base_src)), 'w') as logfile:
-                        cmd = 'cp -rv {} {}'.format(
-                            os.path.abspath(os.path.join(src_path, self.src_dir, '*')), os.path.abspath(build_path)
-                        )
-                        print(indent(' $ {}'.format(cmd), 8))
-                        process = Popen(
-                            args=cmd,
-                            shell=True,
-                            cwd=os.path.abspath(build_path),
-                            env={k: v.format(**state)
-                                 for k, v in self.env.items()},
-                            stdout=logfile,
-                            stderr=logfile
-                        )
-
-                        if process.wait() != 0:
-                            raise Exception('Failed to clone')
-
-                        else:
-                            status = update_status(status_path, {'clone': True})
+            if not is_complete(status_path, 'clone', **state):
+                if in_source_build:
+                    # Clone the source rather than copying it, the build only needs its own copy of what it changes
+                    with open(os.path.join(logs_path, '{}_clone.log'.format(base_src)), 'w') as logfile, \
+                         state['jobserver'].acquire() as jobs:
+                        src = os.path.abspath(src_path if autogen else os.path.join(src_path, self.src_dir))
+                        print(indent(' $ clone {} {}'.format(src, os.path.abspath(build_path)), 8))
+                        count = clone_tree(src, build_path, jobs)
+                        logfile.write('Cloned {} files from {} to {}\n'.format(count, src, os.path.abspath(build_path)))
+
+                    set_complete(status_path, 'clone', **state)
+
+            if autogen:
+                self.autogen(**state)
+
+            env = {k: v.format(**state) for k, v in self.env.items()}
+            cache_file = os.path.join(os.path.abspath(build_path), 'config.cache') if self.configure_cache else None
+
+            loaded = self.load_cache(cache_file, args, env, **state) if cache_file is not None else {}
+            suspect = {}
 
             # Open a log file and run configure
             with open(os.path.join(logs_path, '{}_configure.log'.format(base_src)), 'w') as logfile:
                 cmd = '{} {}'.format(
                     os.path.abspath(
-                        os.path.join(src_path if not self.in_source_build else build_path, self.src_dir, 'configure')
+                        os.path.join(src_path if not in_source_build else build_path, self.src_dir, 'configure')
                     ), ' '.join(args)
                 )
-                print(indent(' $ {}'.format(cmd), 8))
-                process = Popen(
-                    args=cmd,
-                    shell=True,
-                    cwd=os.path.abspath(build_path),
-                    env={k: v.format(**state)
-                         for k, v in self.env.items()},
-                    stdout=logfile,
-                    stderr=logfile
-                )
-                if process.wait() != 0:
+
+                def run(cmd):
+                    print(indent(' $ {}'.format(cmd), 8))
+                    process = Popen(
+                        args=cmd,
+                        shell=True,
+                        cwd=os.path.abspath(build_path),
+                        env=env,
+                        stdout=logfile,
+                        stderr=logfile
+                    )
+                    return process.wait() == 0
+
+                if cache_file is not None:
+                    cmd = '{} --cache-file={}'.format(cmd, cache_file)
+
+                success = run(cmd)
+
+                # Something another library found out might not be true for us, so try again finding everything out
+                # ourselves. When we share what we found any answers we disagree with are never shared again
+                if not success and cache_file is not None:
+                    cprint(
+                        indent('Configure for {} failed using the shared cache, trying without it'.format(base_src), 8),
+                        'yellow',
+                        attrs=['bold']
+                    )
+                    logfile.write('\nConfiguring again without the shared cache\n\n')
+                    os.remove(cache_file)
+                    success = run(cmd)
+                    suspect = loaded
+
+                if not success:
                     raise Exception('Failed to configure')
 
-                else:
-                    status = update_status(status_path, {'configure': True})
+            if cache_file is not None:
+                self.save_cache(cache_file, args, env, suspect, **state)
+
+            set_complete(status_path, 'configure', **state)
 
         else:
             cprint(
@@ -165,6 +212,59 @@ class AutotoolsBuild:
 
         return {'build': build_path, 'logs': logs_path}
 
+    def cache_status_path(self, args, env, **state):
+        # Builds with the same compiler, flags and target find out the same things
+        key = get_fingerprint(
+            [env.get(k) for k in AutotoolsBuild.CACHE_ENV],
+            [a for a in args if a.startswith(('--host', '--build', '--target'))],
+        )
+        return os.path.join(state['status_dir'], 'config_cache', '{}.json'.format(key))
+
+    def load_cache(self, cache_file, args, env, **state):
+        entries = get_status(self.cache_status_path(args, env, **state))
+
+        # Anything our own environment sets is ours to decide, and caches from before we were this careful can hold more
+        # than we share now
+        entries = {
+            k: v
+            for k, v in entries.items()
+            if v is not None and k not in env and k.startswith(AutotoolsBuild.CACHE_SHARED)
+        }
+
+        with open(cache_file, 'w') as f:
+            for name, line in sorted(entries.items()):
+                f.write('{}\n'.format(line))
+
+        return entries
+
+    def save_cache(self, cache_file, args, env, suspect, **state):
+        status_path = self.cache_status_path(args, env, **state)
+
+        found = {}
+        for name, value, line in read_cache(cache_file):
+            # A no might become a yes once another library is installed, and anything that mentions our own folders
+            # or was decided by our environment is only true for us
+            if name.startswith(AutotoolsBuild.CACHE_SHARED) \
+               and value.strip('\'"') != 'no' and name not in env \
+               and os.path.abspath(state['builds_dir']) not in line and os.path.abspath(state['source']) not in line:
+                found[name] = line
+
+        with lock(get_lock_path(status_path, **state)):
+            entries = get_status(status_path)
+
+            # When two libraries disagree the answer must depend on the library, so nobody gets it
+            updates = {
+                name: line if entries.get(name, line) == line else None
+                for name, line in found.items()
+                if name not in entries or entries[name] is not None
+            }
+
+            # If the shared answers broke our configure we can't tell which one did it, so stop sharing any of them we
+            # couldn't confirm ourselves
+            updates.update({name: None for name, line in suspect.items() if found.get(name) != line})
+
+            update_status(status_path, updates)
+
     def build(self, **state):
 
         # Work out our real full paths
@@ -177,21 +277,19 @@ class AutotoolsBuild:
             if v is not None
         ]
 
-        # Load the status file
-        status = get_status(status_path)
-
-        # Otherwise run make for each of our targets
+        # Otherwise run make for each of our targets, sharing the jobserver with every other build
         for target in self.build_targets:
-            if 'make_{}'.format(target) not in status or not status['make_{}'.format(target)]:
+            if not is_complete(status_path, 'make_{}'.format(target), **state):
                 with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile:
-                    cmd = 'make -j{} {} {}'.format(state['cpu_count'], ' '.join(args), target)
+                    cmd = 'make {} {}'.format(' '.join(args), target)
                     print(indent(' $ {}'.format(cmd), 8))
                     process = Popen(
                         args=cmd,
                         shell=True,
                         cwd=os.path.abspath(build_path),
-                        env={k: v.format(**state)
-                             for k, v in self.env.items()},
+                        env=state['jobserver'].env({k: v.format(**state)
+                                                    for k, v in self.env.items()}),
+                        pass_fds=state['jobserver'].fds,
                         stdout=logfile,
                         stderr=logfile
                     )
@@ -199,7 +297,7 @@ class AutotoolsBuild:
                         raise Exception('Failed to run make {}'.format(target))
 
                     else:
-                        status = update_status(status_path, {'make_{}'.format(target): True})
+                        set_complete(status_path, 'make_{}'.format(target), **state)
 
             else:
                 cprint(
@@ -220,12 +318,9 @@ class AutotoolsBuild:
             if v is not None
         ]
 
-        # Load the status file
-        status = get_status(status_path)
-
         # Open a log file and run make install
         for target in self.install_targets:
-            if target not in status or not status[target]:
+            if not is_complete(status_path, target, **state):
                 with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile:
                     cmd = 'make {} {}'.format(' '.join(args), target)
                     print(indent(' $ {}'.format(cmd), 8))
@@ -243,7 +338,7 @@ class AutotoolsBuild:
                         raise Exception('Failed to run make {}'.format(target))
 
                     else:
-                        status = update_status(status_path, {target: True})
+                        set_complete(status_path, target, **state)
 
             else:
                 cprint(
@@ -251,3 +346,19 @@ class AutotoolsBuild:
                     'yellow',
                     attrs=['bold']
                 )
+
+
+def read_cache(path):
+
+    if not os.path.isfile(path):
+        return []
+
+    # Cache entries are written as name=${name=value}
+    entries = []
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            match = re.match(r'^(\w+)=\$\{\1=(.*)\}$', line.rstrip('\n'))
+            if match:
+                entries.append((match.group(1), match.group(2), match.group(0)))
+
+    return entries
@@ -5,7 +5,7 @@ import shutil
 from subprocess import Popen
 from termcolor import cprint
 
-from ..util import get_status, update_status, indent, parse_args, dedent, get_paths
+from ..util import is_complete, set_complete, get_env_changes, clone_tree, indent, parse_args, dedent, get_paths
 
 
 class BoostBuild:
@@ -58,6 +58,14 @@ class BoostBuild:
         # Because asshats.
         self.in_source_build = build_args.get('in_source_build', False)
 
+    def inputs(self, phase, **state):
+        env = get_env_changes(self.env)
+        return {
+            'configure': [self.configure_args, self.src_dir, self.in_source_build, env],
+            'build': [self.build_args, self.build_targets, env],
+            'install': [self.install_args, self.install_targets, env],
+        }.get(phase)
+
     def configure(self, **state):
 
         # Work out our real full paths
@@ -66,10 +74,7 @@ class BoostBuild:
         # Apply our state
         args = parse_args(self.configure_args, **state)
 
-        # Load the status file.
-        status = get_status(status_path)
-
-        if 'configure' not in status or not status['configure']:
+        if not is_complete(status_path, 'configure', **state):
             # Wipe build folder before reconfigure
             if os.path.isdir(build_path):
                 shutil.rmtree(build_path)
@@ -78,27 +83,15 @@ class BoostBuild:
             os.makedirs(build_path, exist_ok=True)
             os.makedirs(logs_path, exist_ok=True)
 
-            if 'clone' not in status or not status['clone']:
-                with open(os.path.join(logs_path, '{}_clone.log'.format(base_src)), 'w') as logfile:
-                    cmd = 'cp -rv {} {}'.format(
-                        os.path.abspath(os.path.join(src_path, self.src_dir, '*')), os.path.abspath(build_path)
-                    )
-                    print(indent(' $ {}'.format(cmd), 8))
-                    process = Popen(
-                        args=cmd,
-                        shell=True,
-                        cwd=os.path.abspath(build_path),
-                        env={k: v.format(**state)
-                             for k, v in self.env.items()},
-                        stdout=logfile,
-                        stderr=logfile
-                    )
-
-                    if process.wait() != 0:
-                        raise Exception('Failed to clone')
+            if not is_complete(status_path, 'clone', **state):
+                with open(os.path.join(logs_path, '{}_clone.log'.format(base_src)), 'w') as logfile, \
+                     state['jobserver'].acquire() as jobs:
+                    src = os.path.abspath(os.path.join(src_path, self.src_dir))
+                    print(indent(' $ clone {} {}'.format(src, os.path.abspath(build_path)), 8))
+                    count = clone_tree(src, build_path, jobs)
+                    logfile.write('Cloned {} files from {} to {}\n'.format(count, src, os.path.abspath(build_path)))
 
-                    else:
-                        status = update_status(status_path, {'clone': True})
+                set_complete(status_path, 'clone', **state)
 
             # Make sure boost is going to use our compiler.
             with open(os.path.join(os.path.abspath(build_path), 'user-config.jam'), 'w') as config:
@@ -125,7 +118,7 @@ class BoostBuild:
                     raise Exception('Failed to configure')
 
                 else:
-                    status = update_status(status_path, {'configure': True})
+                    set_complete(status_path, 'configure', **state)
 
         else:
             cprint(
@@ -142,16 +135,15 @@ class BoostBuild:
         # Apply our state
         args = parse_args(self.build_args, **state)
 
-        # Load the status file.
-        status = get_status(status_path)
-
         # Otherwise run make for each of our targets
         if len(self.build_targets) > 0:
-            if 'make' not in status or not status['make']:
-                with open(os.path.join(logs_path, '{}_make.log'.format(base_src)), 'w') as logfile:
+            if not is_complete(status_path, 'make', **state):
+                # b2 can't use a jobserver so take as many jobs as we can from it up front
+                with open(os.path.join(logs_path, '{}_make.log'.format(base_src)),
+                          'w') as logfile, state['jobserver'].acquire() as jobs:
                     cmd = '{} -j{} {}'.format(
                         self.bjam_path.format(**state)
-                        if self.bjam_path else './bjam', state['cpu_count'], ' '.join(args)
+                        if self.bjam_path else './bjam', jobs, ' '.join(args)
                     )
                     print(indent(' $ {}'.format(cmd), 8))
                     process = Popen(
@@ -167,7 +159,7 @@ class BoostBuild:
                         raise Exception('Failed to run make')
 
                     else:
-                        status = update_status(status_path, {'make': True})
+                        set_complete(status_path, 'make', **state)
 
             else:
                 cprint(
@@ -182,16 +174,15 @@ class BoostBuild:
         # Apply our state
         args = parse_args(self.install_args, **state)
 
-        # Load the status file.
-        status = get_status(status_path)
-
         # Open a log file and run make install
         if len(self.install_targets) > 0:
-            if 'install' not in status or not status['install']:
-                with open(os.path.join(logs_path, '{}_install.log'.format(base_src)), 'w') as logfile:
+            if not is_complete(status_path, 'install', **state):
+                # b2 can't use a jobserver so take as many jobs as we can from it up front
+                with open(os.path.join(logs_path, '{}_install.log'.format(base_src)),
+                          'w') as logfile, state['jobserver'].acquire() as jobs:
                     cmd = '{} -j{} {} install'.format(
                         self.bjam_path.format(**state)
-                        if self.bjam_path else './bjam', state['cpu_count'], ' '.join(args)
+                        if self.bjam_path else './bjam', jobs, ' '.join(args)
                     )
                     print(indent(' $ {}'.format(cmd), 8))
                     process = Popen(
@@ -208,7 +199,7 @@ class BoostBuild:
                         raise Exception('Failed to run install')
 
                     else:
-                        status = update_status(status_path, {'install': True})
+                        set_complete(status_path, 'install', **state)
 
             else:
                 cprint(
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import shutil
 from subprocess import Popen
+from contextlib import ExitStack
 from termcolor import cprint
 
-from ..util import get_status, update_status, indent, get_paths
+from ..util import is_complete, set_complete, get_env_changes, indent, get_paths, get_status, update_status
 
 
 class CMakeBuild:
@@ -44,6 +46,37 @@ class CMakeBuild:
         # Because asshats.
         self.in_source_build = build_args.get('in_source_build', False)
 
+        # The build system cmake generates for us, Ninja if we have it unless we are told otherwise
+        self.generator = build_args.get('generator', None)
+
+    def inputs(self, phase, **state):
+        env = get_env_changes(self.env)
+        return {
+            'configure': [self.configure_args, self.get_generator(**state), self.src_dir, self.in_source_build, env],
+            'build': [self.build_args, self.build_targets, env],
+            'install': [self.install_args, self.install_targets, env],
+        }.get(phase)
+
+    def get_generator(self, **state):
+        if self.generator is not None:
+            return self.generator
+
+        # Once a build has picked its generator it keeps it, whether we happen to have ninja right now doesn't change it
+        _, _, _, _, status_path = get_paths(self.build_postfix, **state)
+        generator = get_status(status_path).get('generator')
+        if generator is not None:
+            return generator
+
+        path = self.env.get('PATH', '').format(**state)
+        return 'Ninja' if shutil.which('ninja', path=path) is not None else 'Unix Makefiles'
+
+    def command(self, target, args, stack, **state):
+        # Ninja can't share a jobserver so it gets as many jobs as we can take for it, make takes its own as it goes
+        if self.get_generator(**state) == 'Ninja':
+            args = ['-j{}'.format(stack.enter_context(state['jobserver'].acquire()))] + args
+
+        return 'cmake --build . --target {}{}'.format(target, ' -- {}'.format(' '.join(args)) if args else '')
+
     def configure(self, **state):
 
         # Work out our real full paths
@@ -62,12 +95,12 @@ class CMakeBuild:
             if v is not None
         ]
 
-        # Load the status file
-        status = get_status(status_path)
+        if not is_complete(status_path, 'configure', **state):
+            generator = self.get_generator(**state)
 
-        if 'configure' not in status or not status['configure']:
-            # Wipe build folder before reconfigure
-            if os.path.isdir(build_path):
+            # Reconfigure the build we already have so only what changed gets rebuilt, unless cmake can't change it
+            if os.path.isdir(build_path) and not self.reconfigurable(build_path, src_path, generator, **state):
+                cprint(indent('Wiping build of {} before reconfiguring'.format(base_src), 8), 'yellow', attrs=['bold'])
                 shutil.rmtree(build_path)
 
             # Make our build directory and log directory
@@ -76,7 +109,9 @@ class CMakeBuild:
 
             # Open a log file and run configure
             with open(os.path.join(logs_path, '{}_configure.log'.format(base_src)), 'w') as logfile:
-                cmd = 'cmake {} {}'.format(' '.join(args), os.path.abspath(os.path.join(src_path, self.src_dir)))
+                cmd = 'cmake -G "{}" {} {}'.format(
+                    generator, ' '.join(args), os.path.abspath(os.path.join(src_path, self.src_dir))
+                )
                 print(indent(' $ {}'.format(cmd), 8))
                 process = Popen(
                     args=cmd,
@@ -91,7 +126,8 @@ class CMakeBuild:
                     raise Exception('Failed to configure')
 
                 else:
-                    status = update_status(status_path, {'configure': True})
+                    update_status(status_path, {'generator': generator})
+                    set_complete(status_path, 'configure', **state)
 
         else:
             cprint(
@@ -100,6 +136,48 @@ class CMakeBuild:
 
         return {'build': build_path, 'logs': logs_path}
 
+    def reconfigurable(self, build_path, src_path, generator, **state):
+
+        cache = read_cache(os.path.join(build_path, 'CMakeCache.txt'))
+
+        # Nothing was configured here, cmake can start from whatever is in the folder
+        if not cache:
+            return True
+
+        args = {k: v for k, v in self.configure_args.items() if v is not None}
+        env = {k: v.format(**state) for k, v in self.env.items()}
+
+        def same_path(a, b):
+            return a is not None and b is not None and os.path.realpath(a) == os.path.realpath(b)
+
+        # Once a build tree exists cmake won't change its generator, source folder or toolchain file
+        if cache.get('CMAKE_GENERATOR') != generator:
+            return False
+
+        if not same_path(cache.get('CMAKE_HOME_DIRECTORY'), os.path.join(src_path, self.src_dir)):
+            return False
+
+        toolchain_file = args.get('-DCMAKE_TOOLCHAIN_FILE')
+        if toolchain_file is not None:
+            if not same_path(cache.get('CMAKE_TOOLCHAIN_FILE'), toolchain_file.format(**state)):
+                return False
+
+        # It keeps whichever compilers it found the first time too, the toolchain file picks them if we have one
+        elif 'CMAKE_TOOLCHAIN_FILE' in cache:
+            return False
+
+        else:
+            for variable, compiler in (('CMAKE_C_COMPILER', 'CC'), ('CMAKE_CXX_COMPILER', 'CXX')):
+                wanted = args.get('-D{}'.format(variable))
+                wanted = wanted.format(**state) if wanted is not None else env.get(compiler)
+
+                if wanted is not None and variable in cache:
+                    found = shutil.which(wanted.split()[0], path=env.get('PATH'))
+                    if found is not None and not same_path(cache[variable], found):
+                        return False
+
+        return True
+
     def build(self, **state):
 
         # Work out our real full paths
@@ -112,29 +190,28 @@ class CMakeBuild:
             if v is not None
         ]
 
-        # Load the status file
-        status = get_status(status_path)
-
-        # Otherwise run make for each of our targets
+        # Build each of our targets, sharing the jobserver with every other build
         for target in self.build_targets:
-            if 'make_{}'.format(target) not in status or not status['make_{}'.format(target)]:
-                with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile:
-                    cmd = 'make -j{} {} {}'.format(state['cpu_count'], ' '.join(args), target)
+            if not is_complete(status_path, 'make_{}'.format(target), **state):
+                with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile, \
+                     ExitStack() as stack:
+                    cmd = self.command(target, args, stack, **state)
                     print(indent(' $ {}'.format(cmd), 8))
                     process = Popen(
                         args=cmd,
                         shell=True,
                         cwd=os.path.abspath(build_path),
-                        env={k: v.format(**state)
-                             for k, v in self.env.items()},
+                        env=state['jobserver'].env({k: v.format(**state)
+                                                    for k, v in self.env.items()}),
+                        pass_fds=state['jobserver'].fds,
                         stdout=logfile,
                         stderr=logfile
                     )
                     if process.wait() != 0:
-                        raise Exception('Failed to run make {}'.format(target))
+                        raise Exception('Failed to build {}'.format(target))
 
                     else:
-                        status = update_status(status_path, {'make_{}'.format(target): True})
+                        set_complete(status_path, 'make_{}'.format(target), **state)
 
             else:
                 cprint(
@@ -155,30 +232,29 @@ class CMakeBuild:
             if v is not None
         ]
 
-        # Load the status file
-        status = get_status(status_path)
-
-        # Open a log file and run make install
+        # Open a log file and build each install target
         for target in self.install_targets:
-            if target not in status or not status[target]:
-                with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile:
-                    cmd = 'make {} {}'.format(' '.join(args), target)
+            if not is_complete(status_path, target, **state):
+                with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile, \
+                     ExitStack() as stack:
+                    cmd = self.command(target, args, stack, **state)
                     print(indent(' $ {}'.format(cmd), 8))
                     process = Popen(
                         args=cmd,
                         shell=True,
                         cwd=os.path.abspath(build_path),
-                        env={k: v.format(**state)
-                             for k, v in self.env.items()},
+                        env=state['jobserver'].env({k: v.format(**state)
+                                                    for k, v in self.env.items()}),
+                        pass_fds=state['jobserver'].fds,
                         stdout=logfile,
                         stderr=logfile
                     )
 
                     if process.wait() != 0:
-                        raise Exception('Failed to run make {}'.format(target))
+                        raise Exception('Failed to build {}'.format(target))
 
                     else:
-                        status = update_status(status_path, {target: True})
+                        set_complete(status_path, target, **state)
 
             else:
                 cprint(
@@ -186,3 +262,18 @@ class CMakeBuild:
                     'yellow',
                     attrs=['bold']
                 )
+
+
+def read_cache(path):
+
+    cache = {}
+
+    if os.path.isfile(path):
+        with open(path, 'r', errors='replace') as f:
+            for line in f:
+                # Entries look like NAME:TYPE=VALUE, everything else is a comment
+                match = re.match(r'^([A-Za-z_][^:=]*):[^=]*=(.*)$', line.rstrip('\n'))
+                if match:
+                    cache[match.group(1)] = match.group(2)
+
+    return cache
@@ -4,7 +4,7 @@ import os
 from subprocess import Popen
 from termcolor import cprint
 
-from ..util import get_status, update_status, indent, get_paths
+from ..util import is_complete, set_complete, get_env_changes, clone_tree, indent, get_paths
 
 
 class MakeBuild:
@@ -27,38 +27,33 @@ class MakeBuild:
         if 'env' in build_args:
             self.env.update(build_args['env'])
 
+    def inputs(self, phase, **state):
+        env = get_env_changes(self.env)
+        return {
+            'configure': [self.src_dir, env],
+            'build': [self.build_args, self.build_targets, env],
+            'install': [self.install_args, self.install_targets, env],
+        }.get(phase)
+
     def configure(self, **state):
 
         # Work out our real full paths
         src_path, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
 
-        # Load the status file.
-        status = get_status(status_path)
-
-        if 'configure' not in status or not status['configure']:
+        if not is_complete(status_path, 'configure', **state):
             # Make our build directory and log directory
             os.makedirs(build_path, exist_ok=True)
             os.makedirs(logs_path, exist_ok=True)
 
-            with open(os.path.join(logs_path, '{}_configure.log'.format(base_src)), 'w') as logfile:
-                cmd = 'cp -rv {} {}/'.format(
-                    os.path.abspath(os.path.join(src_path, self.src_dir, '*')), os.path.abspath(build_path)
-                )
-                print(indent(' $ {}'.format(cmd), 8))
-                process = Popen(
-                    args=cmd,
-                    shell=True,
-                    cwd=os.path.abspath(build_path),
-                    env={k: v.format(**state)
-                         for k, v in self.env.items()},
-                    stdout=logfile,
-                    stderr=logfile
-                )
-                if process.wait() != 0:
-                    raise Exception('Failed to run configure')
+            # Make builds in the source tree, so it gets a clone of the source to itself
+            with open(os.path.join(logs_path, '{}_configure.log'.format(base_src)), 'w') as logfile, \
+                 state['jobserver'].acquire() as jobs:
+                src = os.path.abspath(os.path.join(src_path, self.src_dir))
+                print(indent(' $ clone {} {}'.format(src, os.path.abspath(build_path)), 8))
+                count = clone_tree(src, build_path, jobs)
+                logfile.write('Cloned {} files from {} to {}\n'.format(count, src, os.path.abspath(build_path)))
 
-                else:
-                    status = update_status(status_path, {'configure': True})
+            set_complete(status_path, 'configure', **state)
 
         else:
             cprint(
@@ -79,21 +74,19 @@ class MakeBuild:
             if v is not None
         ]
 
-        # Load the status file.
-        status = get_status(status_path)
-
-        # Otherwise run make for each of our targets
+        # Otherwise run make for each of our targets, sharing the jobserver with every other build
         for target in self.build_targets:
-            if 'make_{}'.format(target) not in status or not status['make_{}'.format(target)]:
+            if not is_complete(status_path, 'make_{}'.format(target), **state):
                 with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile:
-                    cmd = 'make -j{} {} {}'.format(state['cpu_count'], ' '.join(args), target)
+                    cmd = 'make {} {}'.format(' '.join(args), target)
                     print(indent(' $ {}'.format(cmd), 8))
                     process = Popen(
                         args=cmd,
                         shell=True,
                         cwd=os.path.abspath(build_path),
-                        env={k: v.format(**state)
-                             for k, v in self.env.items()},
+                        env=state['jobserver'].env({k: v.format(**state)
+                                                    for k, v in self.env.items()}),
+                        pass_fds=state['jobserver'].fds,
                         stdout=logfile,
                         stderr=logfile
                     )
@@ -101,7 +94,7 @@ class MakeBuild:
                         raise Exception('Failed to run make {}'.format(target))
 
                     else:
-                        status = update_status(status_path, {'make_{}'.format(target): True})
+                        set_complete(status_path, 'make_{}'.format(target), **state)
 
             else:
                 cprint(
@@ -122,12 +115,9 @@ class MakeBuild:
             if v is not None
         ]
 
-        # Load the status file.
-        status = get_status(status_path)
-
         # Open a log file and run make install
         for target in self.install_targets:
-            if target not in status or not status[target]:
+            if not is_complete(status_path, target, **state):
                 with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile:
                     cmd = 'make PREFIX={} {} {}'.format(state['prefix_dir'], ' '.join(args), target)
                     print(indent(' $ {}'.format(cmd), 8))
@@ -145,7 +135,7 @@ class MakeBuild:
                         raise Exception('Failed to run make {}'.format(target))
 
                     else:
-                        status = update_status(status_path, {target: True})
+                        set_complete(status_path, target, **state)
 
             else:
                 cprint(
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import os
+import shlex
+import shutil
+from subprocess import Popen
+from termcolor import cprint
+
+from ..util import is_complete, set_complete, get_env_changes, indent, get_paths, dedent
+
+
+class MesonBuild:
+
+    # The cpu families meson knows the parts of our triples by, anything else is called what it is
+    CPU_FAMILIES = {
+        'i386': 'x86',
+        'i486': 'x86',
+        'i586': 'x86',
+        'i686': 'x86',
+        'amd64': 'x86_64',
+        'armv6l': 'arm',
+        'armv7l': 'arm',
+        'armv7a': 'arm',
+        'armhf': 'arm',
+        'arm64': 'aarch64',
+        'powerpc': 'ppc',
+        'powerpc64': 'ppc64',
+        'powerpc64le': 'ppc64',
+    }
+
+    CROSS_TEMPLATE = dedent(
+        """\
+        [binaries]
+        c = {cc}
+        cpp = {cxx}
+        ar = {ar}
+        strip = {strip}
+        pkgconfig = {pkgconfig}
+
+        [properties]
+        c_args = {c_args}
+        cpp_args = {cxx_args}
+        sys_root = {sysroot}
+        pkg_config_libdir = {pkg_config_libdir}
+
+        [host_machine]
+        system = 'linux'
+        cpu_family = {cpu_family}
+        cpu = {cpu}
+        endian = {endian}
+        """
+    )
+
+    def __init__(self, **build_args):
+
+        # Build our environment variables
+        self.env = dict(os.environ)
+
+        # Merge in extra env
+        if 'env' in build_args:
+            self.env.update(build_args['env'])
+
+        # Set our default configuration arguments
+        self.configure_args = {
+            '--prefix': '{prefix_dir}',
+            '--libdir': 'lib',
+            '--buildtype': 'minsize',
+            '--default-library': 'both',
+        }
+
+        # Meson is told how to cross compile with a file rather than by its environment
+        if 'CROSS_COMPILE' in self.env and self.env['CROSS_COMPILE']:
+            self.configure_args.update({'--cross-file': '{meson_cross_file}'})
+
+        self.configure_args.update(build_args.get('configure_args', {}))
+        self.src_dir = build_args.get('src_dir', '.')
+        self.build_postfix = build_args.get('build_postfix', '')
+        self.build_args = build_args.get('build_args', {})
+        self.install_args = build_args.get('install_args', {})
+
+        # Grab our build and install targets
+        self.build_targets = build_args.get('build_targets', ['all'])
+        self.install_targets = build_args.get('install_targets', ['install'])
+
+    def inputs(self, phase, **state):
+        env = get_env_changes(self.env)
+        return {
+            'configure': [self.configure_args, self.cross_file(**state), self.src_dir, env],
+            'build': [self.build_args, self.build_targets, env],
+            'install': [self.install_args, self.install_targets, env],
+        }.get(phase)
+
+    def available(self, **state):
+        # We can only build with meson if it and ninja are installed
+        path = self.env.get('PATH', '').format(**state)
+        return all(shutil.which(tool, path=path) is not None for tool in ('meson', 'ninja'))
+
+    def cross_file(self, **state):
+
+        # Native builds find their compiler from the environment like everyone else
+        if not self.env.get('CROSS_COMPILE'):
+            return None
+
+        env = {k: v.format(**state) for k, v in self.env.items()}
+        triple = state['target_triple']
+        arch = triple.split('-')[0]
+
+        def string(s):
+            return "'{}'".format(s.replace('\\', '\\\\').replace('\'', '\\\''))
+
+        def array(items):
+            return '[{}]'.format(', '.join(string(i) for i in items))
+
+        return MesonBuild.CROSS_TEMPLATE.format(
+            cc=array(shlex.split(env.get('CC', '{}-gcc'.format(triple)))),
+            cxx=array(shlex.split(env.get('CXX', '{}-g++'.format(triple)))),
+            ar=array(shlex.split(env.get('AR', '{}-ar'.format(triple)))),
+            strip=array(shlex.split(env.get('STRIP', '{}-strip'.format(triple)))),
+            pkgconfig=array(shlex.split(env.get('PKG_CONFIG', 'pkg-config'))),
+            c_args=array(shlex.split(env.get('CFLAGS', ' '.join(state['c_flags'])))),
+            cxx_args=array(shlex.split(env.get('CXXFLAGS', ' '.join(state['cxx_flags'])))),
+            sysroot=string(state['prefix_dir']),
+            pkg_config_libdir=array(
+                [
+                    os.path.join(state['prefix_dir'], 'lib', 'pkgconfig'),
+                    os.path.join(state['prefix_dir'], 'share', 'pkgconfig')
+                ]
+            ),
+            cpu_family=string(MesonBuild.CPU_FAMILIES.get(arch, arch)),
+            cpu=string(arch),
+            endian=string('big' if arch.endswith(('eb', 'be')) or arch in ('powerpc', 'powerpc64') else 'little'),
+        )
+
+    def command(self, target, args, jobs):
+        # Ninja can't share a jobserver so it gets as many jobs as we can take for it
+        return 'ninja -j{} {}'.format(jobs, ' '.join(args + [target]))
+
+    def configure(self, **state):
+
+        # Work out our real full paths
+        src_path, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
+
+        # Our cross file lives next to our build so it can't get in meson's way
+        if 'meson_cross_file' not in state:
+            state.update({'meson_cross_file': os.path.abspath('{}.cross'.format(build_path))})
+
+        # Apply our state
+        args = [
+            '{}{}'.format(k, '={}'.format(v) if v is not True else '').format(**state)
+            for k, v in self.configure_args.items()
+            if v is not None
+        ]
+
+        if not is_complete(status_path, 'configure', **state):
+            cross_file = self.cross_file(**state)
+
+            # Meson keeps whatever cross file it was first given, so a new one needs a new build
+            if cross_file is not None and os.path.isdir(build_path):
+                old = None
+                if os.path.isfile(state['meson_cross_file']):
+                    with open(state['meson_cross_file'], 'r') as f:
+                        old = f.read()
+
+                if old != cross_file:
+                    cprint(
+                        indent('Wiping build of {} before reconfiguring'.format(base_src), 8), 'yellow', attrs=['bold']
+                    )
+                    shutil.rmtree(build_path)
+
+            # Make our build directory and log directory
+            os.makedirs(build_path, exist_ok=True)
+            os.makedirs(logs_path, exist_ok=True)
+
+            if cross_file is not None:
+                with open(state['meson_cross_file'], 'w') as f:
+                    f.write(cross_file)
+
+            # Reconfigure the build we already have so only what changed gets rebuilt
+            if os.path.isfile(os.path.join(build_path, 'meson-private', 'coredata.dat')):
+                args.append('--reconfigure')
+
+            # Open a log file and run configure
+            with open(os.path.join(logs_path, '{}_configure.log'.format(base_src)), 'w') as logfile:
+                cmd = 'meson setup {} {} {}'.format(
+                    ' '.join(args), os.path.abspath(build_path), os.path.abspath(os.path.join(src_path, self.src_dir))
+                )
+                print(indent(' $ {}'.format(cmd), 8))
+                process = Popen(
+                    args=cmd,
+                    shell=True,
+                    cwd=os.path.abspath(build_path),
+                    env={k: v.format(**state)
+                         for k, v in self.env.items()},
+                    stdout=logfile,
+                    stderr=logfile
+                )
+                if process.wait() != 0:
+                    raise Exception('Failed to configure')
+
+                else:
+                    set_complete(status_path, 'configure', **state)
+
+        else:
+            cprint(
+                indent('Configure step for {} complete... Skipping...'.format(base_src), 8), 'yellow', attrs=['bold']
+            )
+
+        return {'build': build_path, 'logs': logs_path}
+
+    def build(self, **state):
+
+        # Work out our real full paths
+        _, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
+
+        # Apply our state
+        args = [
+            '{}{}'.format(k, '={}'.format(v) if v is not True else '').format(**state)
+            for k, v in self.build_args.items()
+            if v is not None
+        ]
+
+        # Build each of our targets
+        for target in self.build_targets:
+            if not is_complete(status_path, 'make_{}'.format(target), **state):
+                with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile, \
+                     state['jobserver'].acquire() as jobs:
+                    cmd = self.command(target, args, jobs)
+                    print(indent(' $ {}'.format(cmd), 8))
+                    process = Popen(
+                        args=cmd,
+                        shell=True,
+                        cwd=os.path.abspath(build_path),
+                        env={k: v.format(**state)
+                             for k, v in self.env.items()},
+                        stdout=logfile,
+                        stderr=logfile
+                    )
+                    if process.wait() != 0:
+                        raise Exception('Failed to build {}'.format(target))
+
+                    else:
+                        set_complete(status_path, 'make_{}'.format(target), **state)
+
+            else:
+                cprint(
+                    indent('Build step {} for {} complete... Skipping...'.format(target, base_src), 8),
+                    'yellow',
+                    attrs=['bold']
+                )
+
+    def install(self, **state):
+
+        # Work out our real full paths
+        _, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
+
+        # Apply our state
+        args = [
+            '{}{}'.format(k, '={}'.format(v) if v is not True else '').format(**state)
+            for k, v in self.install_args.items()
+            if v is not None
+        ]
+
+        # Open a log file and build each install target
+        for target in self.install_targets:
+            if not is_complete(status_path, target, **state):
+                with open(os.path.join(logs_path, '{}_make_{}.log'.format(base_src, target)), 'w') as logfile, \
+                     state['jobserver'].acquire() as jobs:
+                    cmd = self.command(target, args, jobs)
+                    print(indent(' $ {}'.format(cmd), 8))
+                    process = Popen(
+                        args=cmd,
+                        shell=True,
+                        cwd=os.path.abspath(build_path),
+                        env={k: v.format(**state)
+                             for k, v in self.env.items()},
+                        stdout=logfile,
+                        stderr=logfile
+                    )
+
+                    if process.wait() != 0:
+                        raise Exception('Failed to build {}'.format(target))
+
+                    else:
+                        set_complete(status_path, target, **state)
+
+            else:
+                cprint(
+                    indent('Install step {} for {} complete... Skipping...'.format(target, base_src), 8),
+                    'yellow',
+                    attrs=['bold']
+                )
@@ -6,7 +6,7 @@ import shutil
 from subprocess import Popen
 from termcolor import cprint
 
-from ..util import get_status, update_status, indent, dedent, get_paths
+from ..util import is_complete, set_complete, get_env_changes, clone_tree, indent, dedent, get_paths
 
 
 class PythonBuild:
@@ -22,7 +22,7 @@ class PythonBuild:
 
         # Set our default build arguments
         self.build_args = {
-            '--parallel': '{cpu_count}',
+            '--parallel': '{jobs}',
             '--compiler': 'unix',
             '--executable': os.path.join('{prefix_dir}', 'bin', 'python3')
         }
@@ -35,15 +35,20 @@ class PythonBuild:
         self.build_args.update(build_args.get('build_args', {}))
         self.install_args.update(build_args.get('install_args', {}))
 
+    def inputs(self, phase, **state):
+        env = get_env_changes(self.env)
+        return {
+            'configure': [self.src_dir, env],
+            'build': [self.build_args, env],
+            'install': [self.install_args, env],
+        }.get(phase)
+
     def configure(self, **state):
 
         # Work out our real full paths
         src_path, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
 
-        # Load the status file
-        status = get_status(status_path)
-
-        if 'configure' not in status or not status['configure']:
+        if not is_complete(status_path, 'configure', **state):
             # Wipe build folder before reconfigure
             if os.path.isdir(build_path):
                 shutil.rmtree(build_path)
@@ -52,29 +57,17 @@ class PythonBuild:
             os.makedirs(build_path, exist_ok=True)
             os.makedirs(logs_path, exist_ok=True)
 
-            if 'clone' not in status or not status['clone']:
-                with open(os.path.join(logs_path, '{}_clone.log'.format(base_src)), 'w') as logfile:
-                    cmd = 'cp -rv {} {}'.format(
-                        os.path.abspath(os.path.join(src_path, self.src_dir, '*')), os.path.abspath(build_path)
-                    )
-                    print(indent(' $ {}'.format(cmd), 8))
-                    process = Popen(
-                        args=cmd,
-                        shell=True,
-                        cwd=os.path.abspath(build_path),
-                        env={k: v.format(**state)
-                             for k, v in self.env.items()},
-                        stdout=logfile,
-                        stderr=logfile
-                    )
-
-                    if process.wait() != 0:
-                        raise Exception('Failed to clone')
-
-                    else:
-                        status = update_status(status_path, {'clone': True})
-
-            status = update_status(status_path, {'configure': True})
+            if not is_complete(status_path, 'clone', **state):
+                with open(os.path.join(logs_path, '{}_clone.log'.format(base_src)), 'w') as logfile, \
+                     state['jobserver'].acquire() as jobs:
+                    src = os.path.abspath(os.path.join(src_path, self.src_dir))
+                    print(indent(' $ clone {} {}'.format(src, os.path.abspath(build_path)), 8))
+                    count = clone_tree(src, build_path, jobs)
+                    logfile.write('Cloned {} files from {} to {}\n'.format(count, src, os.path.abspath(build_path)))
+
+                set_complete(status_path, 'clone', **state)
+
+            set_complete(status_path, 'configure', **state)
 
         else:
             cprint(
@@ -88,18 +81,18 @@ class PythonBuild:
         # Work out our real full paths
         _, base_src, logs_path, build_path, status_path = get_paths(self.build_postfix, **state)
 
-        # Apply our state
-        args = [
-            '{}{}'.format(k, '={}'.format(v) if v is not True else '').format(**state)
-            for k, v in self.build_args.items()
-            if v is not None
-        ]
+        if not is_complete(status_path, 'build', **state):
+            # setup.py can't use a jobserver so take as many jobs as we can from it up front
+            with open(os.path.join(logs_path, '{}_build.log'.format(base_src)),
+                      'w') as logfile, state['jobserver'].acquire() as jobs:
 
-        # Load the status file
-        status = get_status(status_path)
+                # Apply our state
+                args = [
+                    '{}{}'.format(k, '={}'.format(v) if v is not True else '').format(jobs=jobs, **state)
+                    for k, v in self.build_args.items()
+                    if v is not None
+                ]
 
-        if 'build' not in status or not status['build']:
-            with open(os.path.join(logs_path, '{}_build.log'.format(base_src)), 'w') as logfile:
                 cmd = '{} ./setup.py build {}'.format(sys.executable, ' '.join(args))
                 print(indent(' $ {}'.format(cmd), 8))
                 process = Popen(
@@ -115,7 +108,7 @@ class PythonBuild:
                     raise Exception('Failed to run build')
 
                 else:
-                    status = update_status(status_path, {'build': True})
+                    set_complete(status_path, 'build', **state)
 
         else:
             cprint(indent('Build step for {} complete... Skipping...'.format(base_src), 8), 'yellow', attrs=['bold'])
@@ -132,11 +125,8 @@ class PythonBuild:
             if v is not None
         ]
 
-        # Load the status file
-        status = get_status(status_path)
-
         # Open a log file and run make install
-        if 'install' not in status or not status['install']:
+        if not is_complete(status_path, 'install', **state):
             with open(os.path.join(logs_path, '{}_install.log'.format(base_src)), 'w') as logfile:
                 cmd = '{} ./setup.py install {}'.format(sys.executable, ' '.join(args))
                 print(indent(' $ {}'.format(cmd), 8))
@@ -154,7 +144,7 @@ class PythonBuild:
                     raise Exception('Failed to run install')
 
                 else:
-                    status = update_status(status_path, {'install': True})
+                    set_complete(status_path, 'install', **state)
 
         else:
             cprint(indent('Install step for {} complete... Skipping...'.format(base_src), 8), 'yellow', attrs=['bold'])
@@ -6,6 +6,7 @@ from .AutotoolsBuild import AutotoolsBuild
 from .BoostBuild import BoostBuild
 from .CMakeBuild import CMakeBuild
 from .MakeBuild import MakeBuild
+from .MesonBuild import MesonBuild
 from .PythonBuild import PythonBuild
 
 
@@ -19,7 +20,11 @@ class SmartBuild:
         self.use_tool = build_args.get('build_tool', None)
         self.build_tool = None
 
-    def configure(self, **state):
+    def select(self, **state):
+
+        # We only pick a tool once, whatever we pick is used for every phase
+        if self.build_tool is not None:
+            return self.build_tool
 
         source = state['source']
 
@@ -33,6 +38,9 @@ class SmartBuild:
             elif self.use_tool == 'boost':
                 self.build_tool = BoostBuild(**self.build_args)
 
+            elif self.use_tool == 'meson':
+                self.build_tool = MesonBuild(**self.build_args)
+
             elif self.use_tool == 'make':
                 self.build_tool = MakeBuild(**self.build_args)
 
@@ -45,6 +53,11 @@ class SmartBuild:
                     source, self.src_dir, 'autogen.sh')):
                 self.build_tool = AutotoolsBuild(**self.build_args)
 
+            # Then check for meson.build, as long as we have meson to build it with
+            elif os.path.isfile(os.path.join(source, self.src_dir, 'meson.build')) and MesonBuild(
+                    **self.build_args).available(**state):
+                self.build_tool = MesonBuild(**self.build_args)
+
             # Then check for CMakeLists.txt
             elif os.path.isfile(os.path.join(source, self.src_dir, 'CMakeLists.txt')):
                 self.build_tool = CMakeBuild(**self.build_args)
@@ -63,7 +76,15 @@ class SmartBuild:
             elif os.path.isfile(os.path.join(source, self.src_dir, 'Makefile')):
                 self.build_tool = MakeBuild(**self.build_args)
 
-        return self.build_tool.configure(**state)
+        return self.build_tool
+
+    def inputs(self, phase, **state):
+
+        return self.select(**state).inputs(phase, **state)
+
+    def configure(self, **state):
+
+        return self.select(**state).configure(**state)
 
     def build(self, **state):
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import tarfile
+import tempfile
+from termcolor import cprint
+
+from .HTTPStore import HTTPStore
+from .LocalStore import LocalStore
+from ..util import indent, get_file_digest, get_status, is_sequence
+
+
+class BuildCache:
+
+    def __init__(self, location):
+
+        # Anything that looks like a URL is a remote cache, anything else is a directory
+        if location.startswith(('http://', 'https://')):
+            self.store = HTTPStore(location)
+        else:
+            self.store = LocalStore(location)
+
+    def key(self, library, state, dependencies):
+
+        toolchain = library.toolchain
+
+        # Our parent toolchain may have been built in another process, so we go by what it recorded rather than what
+        # its libraries hold in this one
+        parent = []
+        if toolchain.parent_toolchain is not None:
+            keys = get_status(os.path.join(toolchain.parent_toolchain.state['status_dir'], 'build_cache.json'))
+            parent = [keys.get(l.name) for l in toolchain.parent_toolchain.libraries]
+
+        # If we don't know exactly what we are built against we can't say which build we are
+        dependencies = [d.cache_key for d in dependencies]
+        if None in parent or None in dependencies:
+            return None
+
+        # Describe the phase handlers, so changing a Shell command or a patch gives a new key
+        handlers = []
+        for ph in library.phase_handlers:
+            commands = getattr(ph, 'commands', None)
+
+            if commands is None:
+                handlers.append(ph.__name__)
+            else:
+                handlers.append({k: self.describe(v) for k, v in commands.items()})
+
+        inputs = {
+            'url': library.url,
+            'archive': self.archive_digest(state),
+            'args': {k: v for k, v in library.build_args.items() if k != 'env'},
+
+            # Only the environment we add matters, the rest of it is whatever machine we happen to be running on
+            'env': {
+                k: v
+                for k, v in library.build_args.get('env', {}).items()
+                if k != 'PATH' and os.environ.get(k) != v
+            },
+            'handlers': handlers,
+            'toolchain': {
+                'triple': state['target_triple'],
+                'parent_triple': state['parent_target_triple'],
+                'prefix_dir': state['prefix_dir'],
+                'c_flags': toolchain.c_flags,
+                'cxx_flags': toolchain.cxx_flags,
+                'fc_flags': toolchain.fc_flags,
+            },
+
+            # Everything we were built against
+            'dependencies': dependencies,
+            'parent': parent,
+        }
+
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def describe(self, command):
+        # Functions are known by their name, and patches from local files by what is in them rather than their path
+        if callable(command):
+            return '{}.{}'.format(command.__module__, command.__qualname__)
+        if is_sequence(command):
+            return [self.describe(c) for c in command]
+        if isinstance(command, str) and os.path.isfile(command):
+            return get_file_digest(command)
+
+        return command
+
+    def archive_digest(self, state):
+        # Our downloader hashes the archive as it arrives, anything else we have to hash ourselves
+        if state.get('archive_digest') is not None:
+            return state['archive_digest']
+
+        return get_file_digest(state['archive']) if os.path.isfile(state.get('archive', '')) else None
+
+    def restore(self, key, prefix_dir):
+
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as artifact:
+            if not self.store.fetch(key, artifact.name):
+                return False
+
+            with tarfile.open(artifact.name, 'r:gz') as tf:
+                tf.extractall(prefix_dir)
+
+        return True
+
+    def save(self, key, prefix_dir, files):
+
+        # Don't cache a library that didn't install anything (most likely it was already installed)
+        if not files:
+            cprint(indent('No installed files to cache for {}'.format(key), 8), 'yellow', attrs=['bold'])
+            return
+
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as artifact:
+            with tarfile.open(artifact.name, 'w:gz') as tf:
+                for f in sorted(files):
+                    tf.add(os.path.join(prefix_dir, f), arcname=f, recursive=False)
+
+            self.store.store(key, artifact.name)
+
+    def snapshot(self, prefix_dir):
+
+        files = {}
+
+        for root, dirs, filenames in os.walk(prefix_dir):
+            # Symlinks to directories (like usr -> .) are listed as dirs but we want them as files
+            for name in filenames + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                files[os.path.relpath(path, prefix_dir)] = (st.st_mtime_ns, st.st_size)
+
+        return files
+
+    def installed_files(self, before, after):
+        return [f for f, s in after.items() if before.get(f) != s]
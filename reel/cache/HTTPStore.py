@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+from ..download import HTTPClient
+
+
+class HTTPStore:
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def path(self, key):
+        return '{}/{}.tar.gz'.format(self.url, key)
+
+    def fetch(self, key, output_file):
+
+        with HTTPClient.get(self.path(key), stream=True) as req:
+
+            if req.status_code == 404:
+                return False
+
+            req.raise_for_status()
+
+            with open(output_file, 'wb') as f:
+                for data in req.iter_content(32 * 1024):
+                    f.write(data)
+
+        return True
+
+    def store(self, key, input_file):
+
+        with open(input_file, 'rb') as f:
+            req = HTTPClient.put(self.path(key), data=f)
+
+        req.raise_for_status()
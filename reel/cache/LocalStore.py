@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+
+
+class LocalStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, '{}.tar.gz'.format(key))
+
+    def fetch(self, key, output_file):
+
+        if not os.path.isfile(self.path(key)):
+            return False
+
+        shutil.copyfile(self.path(key), output_file)
+        return True
+
+    def store(self, key, input_file):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Copy next to the final location then rename so nobody ever sees half an artifact
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        os.close(fd)
+        try:
+            shutil.copyfile(input_file, tmp)
+            os.replace(tmp, self.path(key))
+        except:
+            os.unlink(tmp)
+            raise
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HTTPClient:
+
+    # How many connections we keep open to (and how many requests we make at once to) any one host
+    CONNECTIONS_PER_HOST = 4
+
+    # How many different hosts we keep connections open to
+    HOSTS = 32
+
+    # How many times we retry a failed request, waiting 0.5s, 1s, 2s, ... in between
+    RETRIES = 5
+    BACKOFF = 0.5
+
+    # How long we wait to connect, and for the server to send us something
+    TIMEOUT = (30, 120)
+
+    # One session per process, forked toolchain builds must not share our sockets
+    _sessions = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def session():
+
+        pid = os.getpid()
+
+        with HTTPClient._lock:
+            if pid not in HTTPClient._sessions:
+                retry = Retry(
+                    total=HTTPClient.RETRIES,
+                    backoff_factor=HTTPClient.BACKOFF,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(['HEAD', 'GET', 'PUT']),
+                    raise_on_status=False,
+                )
+
+                # Blocking on the pool is what caps how many requests we make to a host at once
+                adapter = HTTPAdapter(
+                    pool_connections=HTTPClient.HOSTS,
+                    pool_maxsize=HTTPClient.CONNECTIONS_PER_HOST,
+                    pool_block=True,
+                    max_retries=retry,
+                )
+
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                HTTPClient._sessions = {pid: session}
+
+            return HTTPClient._sessions[pid]
+
+    @staticmethod
+    def request(method, url, **kwargs):
+        # A connection is only given back once a response has been read or closed, so streamed responses must always
+        # be read to the end or closed
+        kwargs.setdefault('timeout', HTTPClient.TIMEOUT)
+        return HTTPClient.session().request(method, url, **kwargs)
+
+    @staticmethod
+    def get(url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return HTTPClient.request('GET', url, **kwargs)
+
+    @staticmethod
+    def put(url, **kwargs):
+        return HTTPClient.request('PUT', url, **kwargs)
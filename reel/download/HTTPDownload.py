@@ -1,98 +1,312 @@
 #!/usr/bin/env python3
 
 import os
-import time
-import requests
+import json
+import hashlib
 import rfc6266
-from urllib.parse import urlsplit
-from dateutil import parser
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from termcolor import cprint
 from tqdm import tqdm
 
-from ..util import indent, get_status, update_status
+from .HTTPClient import HTTPClient
+from ..util import indent, get_status, update_status, get_url_status_path, get_file_digest
 
 
 class HTTPDownload:
 
+    # How many pieces we download big files in, and how big a file has to be before we bother
+    SEGMENTS = 4
+    SEGMENT_THRESHOLD = 32 * 1024 * 1024
+
     def __init__(self, **build_args):
         self.url = build_args['url']
-        pass
+
+        # The sha256 the archive must have, if we were told it
+        self.sha256 = build_args.get('sha256')
+        self.sha256 = self.sha256.lower() if self.sha256 is not None else None
+
+        # Something that wants to see the archive as it arrives (like an extractor), given the archive path it returns
+        # a context manager for an object we write to, or None if it isn't interested in this archive
+        self.tee = None
 
     def download(self, **state):
 
         # Load the status file.
-        split = urlsplit(self.url)
-        url_status_file = '{}.json'.format(os.path.join(state['archives_dir'], 'status', split.netloc, split.path[1:]))
+        url_status_file = get_url_status_path(self.url, **state)
         url_status = get_status(url_status_file)
 
-        # Get the headers for the URL
-        if 'downloaded' not in url_status or not url_status['downloaded']:
-            req = requests.get(self.url, allow_redirects=True, stream=True)
-            headers = req.headers
+        archive = url_status.get('archive')
+        downloaded = url_status.get('downloaded', False) and archive is not None and os.path.isfile(archive)
+
+        # An archive that isn't what we were asked for is no use to anyone, so we get it again
+        if downloaded and self.sha256 is not None and self.digest(url_status_file, url_status, archive) != self.sha256:
+            cprint(
+                indent('URL {} does not match its checksum, downloading it again'.format(os.path.basename(archive)), 8),
+                'yellow',
+                attrs=['bold']
+            )
+            os.unlink(archive)
+            url_status = update_status(url_status_file, {'downloaded': False, 'sha256': None})
+            downloaded = False
+
+        # If what we have is exactly what we were asked for there is no need to ask the server anything
+        if downloaded and self.sha256 is not None and url_status.get('sha256') == self.sha256:
+            cprint(
+                indent('URL {} matches its checksum... Skipping...'.format(os.path.basename(archive)), 8),
+                'yellow',
+                attrs=['bold']
+            )
+            return {'archive': archive, 'archive_digest': self.sha256}
+
+        # Ask the server to only send the file if it has changed since we downloaded it
+        headers = {}
+        if downloaded:
+            if url_status.get('etag'):
+                headers['If-None-Match'] = url_status['etag']
+            if url_status.get('last_modified'):
+                headers['If-Modified-Since'] = url_status['last_modified']
+
+        # In offline mode, or if the server gave us nothing to check against, trust what we already have
+        if downloaded and (state.get('offline', False) or not headers):
+            cprint(
+                indent('URL {} not modified... Skipping...'.format(os.path.basename(archive)), 8),
+                'yellow',
+                attrs=['bold']
+            )
+            return {'archive': archive, 'archive_digest': self.digest(url_status_file, url_status, archive)}
+
+        req = None
+
+        # Go straight to wherever we were redirected to last time
+        if downloaded and url_status.get('resolved_url'):
+            req = HTTPClient.get(url_status['resolved_url'], headers=headers, stream=True)
+
+            # Redirects are often to temporary URLs, if it has gone away start again from the real URL
+            if req.status_code not in (200, 304):
+                req.close()
+                req = None
+
+        if req is None:
+            req = HTTPClient.get(self.url, headers=headers, stream=True)
+
+        if req.status_code == 304:
+            req.close()
+            cprint(
+                indent('URL {} not modified... Skipping...'.format(os.path.basename(archive)), 8),
+                'yellow',
+                attrs=['bold']
+            )
+            return {'archive': archive, 'archive_digest': self.digest(url_status_file, url_status, archive)}
+
+        # Give the connection back before we complain
+        if not req.ok:
+            req.close()
+            req.raise_for_status()
+
+        # Extract a filename
+        filename = rfc6266.parse_requests_response(req).filename_unsafe
+
+        # Work out our output path
+        output_file = os.path.join(state['archives_dir'], filename)
+
+        cprint(indent('Downloading {}'.format(filename), 8), 'green', attrs=['bold'])
+
+        # Total size in bytes.
+        total_size = int(req.headers.get('content-length', 0))
+
+        # We can only pick up where we left off if the server does ranges and can tell us the file hasn't changed
+        validator = get_validator(req.headers)
+        ranges = req.headers.get('Accept-Ranges') == 'bytes' and validator is not None and total_size > 0
+
+        # Big files are downloaded in several pieces at once
+        segments = state.get('download_segments', HTTPDownload.SEGMENTS)
+        if ranges and segments > 1 and total_size >= HTTPDownload.SEGMENT_THRESHOLD:
+            size = -(-total_size // segments)
+            segments = [[s, min(s + size, total_size) - 1] for s in range(0, total_size, size)]
+        else:
+            segments = [[0, total_size - 1 if ranges else None]]
 
-            # Extract a filename
-            filename = rfc6266.parse_requests_response(req).filename_unsafe
+        part_files = ['{}.part{}'.format(output_file, i) for i in range(len(segments))]
 
-            # Work out our output path
-            output_file = os.path.join(state['archives_dir'], filename)
+        # Anything left over from downloading a different version of this file, or cut up differently, is useless
+        layout = {'validator': validator, 'size': total_size, 'segments': segments}
+        layout_file = '{}.parts'.format(output_file)
+        if not ranges or read_layout(layout_file) != layout:
+            remove_parts(output_file)
 
-            status_file = os.path.join(state['status_dir'], '{}.json'.format(filename))
+        if ranges:
+            with open(layout_file, 'w') as f:
+                json.dump(layout, f)
 
-            # Load the status file.
-            status = get_status(status_file)
+        # Hash the file as it arrives so we don't have to read it all again afterwards
+        digest = hashlib.sha256()
+        hashed = False
+        tee = None
 
-            # If our file exists compare the last modified of our file vs the one on the server
-            if os.path.exists(output_file):
+        with ExitStack() as stack:
+            stack.callback(req.close)
 
-                # Check if we have a last modified value in our header
-                if 'Last-Modified' in headers:
+            # Report to the shared progress bar when we are one of many downloads
+            progress = state.get('download_progress')
 
-                    # Get when the local and remote files were last modified
-                    l_modified = os.path.getmtime(output_file)
-                    r_modified = time.mktime(parser.parse(headers['Last-Modified']).timetuple())
+            if progress is None:
+                progress = stack.enter_context(tqdm(total=total_size, unit='B', unit_scale=True))
+            else:
+                with progress.get_lock():
+                    progress.total += total_size
+                    progress.refresh()
 
-                    # If we were modified after we don't need to download again
-                    if l_modified > r_modified:
-                        cprint(
-                            indent('URL {} not modified... Skipping...'.format(filename), 8), 'yellow', attrs=['bold']
-                        )
+            # If we are starting from scratch in one piece we can use the response we already have
+            if len(segments) == 1 and not os.path.isfile(part_files[0]):
 
-                        url_status = update_status(url_status_file, {'downloaded': True, 'archive': output_file})
-                        return {'archive': output_file}
+                # Only a download read in order from the start can be handed on as it arrives
+                tee = self.tee(output_file, **state) if self.tee is not None else None
+                tee = stack.enter_context(tee) if tee is not None else None
 
-                # If there is an etag we can use we can check that hasn't changed
-                elif 'Etag' in headers:
-                    if 'download_etag' not in status or status['download_etag'] != headers['Etag']:
-                        status = update_status(status_file, {'download_etag': headers['Etag']})
-                    else:
-                        cprint(
-                            indent('URL {} not modified... Skipping...'.format(filename), 8), 'yellow', attrs=['bold']
-                        )
+                with open(part_files[0], 'wb') as f:
+                    write_stream(req, f, progress, digest, tee)
+                hashed = True
 
-                        url_status = update_status(url_status_file, {'downloaded': True, 'archive': output_file})
-                        return {'archive': output_file}
+            else:
+                req.close()
 
-            cprint(indent('Downloading {}'.format(filename), 8), 'green', attrs=['bold'])
+                whole = len(segments) == 1
 
-            # Total size in bytes.
-            total_size = int(headers.get('content-length', 0))
+                with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+                    futures = [
+                        pool.submit(fetch_segment, req.url, start, end, part, validator, progress, whole)
+                        for (start, end), part in zip(segments, part_files)
+                    ]
 
-            # Get the file
-            with open(output_file, 'wb') as f:
-                with tqdm(total=total_size, unit='B', unit_scale=True) as progress:
-                    for data in req.iter_content(32 * 1024):
+                    for f in futures:
+                        f.result()
+
+        # Stitch the pieces together, hashing anything we haven't seen yet (resumed or segmented downloads)
+        with open(part_files[0], 'r+b') as f:
+            if hashed:
+                f.seek(0, os.SEEK_END)
+            else:
+                for data in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(data)
+
+            for part in part_files[1:]:
+                with open(part, 'rb') as p:
+                    for data in iter(lambda: p.read(1024 * 1024), b''):
+                        digest.update(data)
                         f.write(data)
-                        progress.update(len(data))
+                os.unlink(part)
 
-            url_status = update_status(url_status_file, {'downloaded': True, 'archive': output_file})
+        if os.path.isfile(layout_file):
+            os.unlink(layout_file)
 
-            # Return our updates to state
-            return {'archive': output_file}
+        sha256 = digest.hexdigest()
 
-        else:
-            cprint(
-                indent('URL {} not modified... Skipping...'.format(os.path.basename(url_status['archive'])), 8),
-                'yellow',
-                attrs=['bold']
-            )
-            return {'archive': url_status['archive']}
+        # Never let an archive that isn't what we asked for into place
+        if self.sha256 is not None and sha256 != self.sha256:
+            os.unlink(part_files[0])
+            if tee is not None:
+                tee.discard()
+            raise Exception('Checksum mismatch for {}: expected {} but got {}'.format(self.url, self.sha256, sha256))
+
+        os.replace(part_files[0], output_file)
+
+        # Remember where we ended up and how to ask if it has changed
+        url_status = update_status(
+            url_status_file, {
+                'downloaded': True,
+                'archive': output_file,
+                'resolved_url': req.url,
+                'etag': req.headers.get('ETag'),
+                'last_modified': req.headers.get('Last-Modified'),
+                'sha256': sha256,
+            }
+        )
+
+        # Return our updates to state
+        result = {'archive': output_file, 'archive_digest': sha256}
+
+        if tee is not None and tee.source is not None:
+            result.update({'source': tee.source, 'extracted_archive': output_file})
+
+        return result
+
+    def digest(self, url_status_file, url_status, archive):
+
+        # Archives downloaded before we kept digests get hashed once and remembered
+        sha256 = url_status.get('sha256')
+        if sha256 is None:
+            sha256 = get_file_digest(archive)
+            update_status(url_status_file, {'sha256': sha256})
+
+        return sha256
+
+
+def get_validator(headers):
+    # If-Range only works with strong ETags, otherwise fall back to the modified date
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return headers.get('Last-Modified')
+
+
+def read_layout(layout_file):
+    try:
+        with open(layout_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_parts(output_file):
+    directory = os.path.dirname(output_file)
+    prefix = '{}.part'.format(os.path.basename(output_file))
+
+    for f in os.listdir(directory):
+        if f.startswith(prefix):
+            os.unlink(os.path.join(directory, f))
+
+
+def write_stream(req, f, progress, digest=None, tee=None):
+    for data in req.iter_content(32 * 1024):
+        f.write(data)
+        if digest is not None:
+            digest.update(data)
+        if tee is not None:
+            tee.write(data)
+        with progress.get_lock():
+            progress.update(len(data))
+
+
+def fetch_segment(url, start, end, part_file, validator, progress, whole):
+
+    # Work out how much of this piece we already have
+    done = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+
+    with progress.get_lock():
+        progress.update(done)
+
+    if end is not None and start + done > end:
+        return
+
+    # Ask for the rest, but only if the file is still the one we started downloading
+    headers = {'Range': 'bytes={}-{}'.format(start + done, end if end is not None else '')}
+    if validator is not None:
+        headers['If-Range'] = validator
+
+    with HTTPClient.get(url, headers=headers, stream=True) as req:
+        req.raise_for_status()
+
+        # If the server ignored our range (or the file changed) we were sent the whole file, which is only useful if
+        # that is what we wanted
+        if req.status_code != 206:
+            if not whole:
+                raise Exception('Server did not honour the range request for {}'.format(url))
+
+            with progress.get_lock():
+                progress.update(-done)
+            done = 0
+
+        with open(part_file, 'ab' if done > 0 else 'wb') as f:
+            write_stream(req, f, progress)
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 
+import os
+
 from .HTTPDownload import HTTPDownload
+from ..extract import SmartExtract
+from ..util import get_status, get_url_status_path
 
 
 class SmartDownload:
 
+    # Downloading never needs anything we build so it can happen ahead of time
+    io_bound = True
+
     def __init__(self, **build_args):
 
         # Start without a downloader
         self._downloader = None
+        self.build_args = build_args
 
         url = build_args.get('url')
+        self.url = url
+        self.sha256 = build_args.get('sha256')
 
         # If we have a URL
         if url is not None:
@@ -19,5 +29,46 @@ class SmartDownload:
             if url.startswith('http://') or url.startswith('https://'):
                 self._downloader = HTTPDownload(**build_args)
 
+    def inputs(self, phase, **state):
+
+        return [self.url, self.sha256]
+
+    def current(self, phase, **state):
+
+        # The archive we got last time has to still be there
+        if not os.path.isfile(state.get('archive', '')):
+            return False
+
+        # And still be what is at our URL, which we only know without asking the server if it was just fetched for us
+        if self.url in state.get('archives', {}):
+            return state['archives'][self.url]['archive_digest'] == state.get('archive_digest')
+
+        if state.get('offline', False):
+            return get_status(get_url_status_path(self.url, **state)).get('sha256') == state.get('archive_digest')
+
+        return False
+
     def download(self, **state):
+
+        # If our archive was already fetched before the build started use that
+        if self.url in state.get('archives', {}):
+            fetched = state['archives'][self.url]
+
+            # Another library may have fetched the same URL without pinning it
+            if self.sha256 is not None and fetched['archive_digest'] != self.sha256.lower():
+                raise Exception(
+                    'Checksum mismatch for {}: expected {} but got {}'.format(
+                        self.url, self.sha256, fetched['archive_digest']
+                    )
+                )
+
+            return dict(fetched)
+
+        if self._downloader is None:
+            raise Exception('Unable to download {}, only http and https URLs are supported'.format(self.url))
+
+        # Extract the archive as it arrives rather than reading it all back in again afterwards
+        if state.get('stream_extract', False):
+            self._downloader.tee = SmartExtract(**self.build_args).tee
+
         return self._downloader.download(**state)
@@ -1,3 +1,5 @@
 #!/usr/bin/env python3
 
 from .SmartDownload import SmartDownload
+from .HTTPDownload import HTTPDownload
+from .HTTPClient import HTTPClient
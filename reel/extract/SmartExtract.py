@@ -1,26 +1,150 @@
 #!/usr/bin/env python3
 
+import os
+import uuid
+import shutil
+from termcolor import cprint
+
 from .TarExtract import TarExtract
 from .ZipExtract import ZipExtract
+from ..util import indent, get_status, update_status, get_file_digest, get_fingerprint
 
 
 class SmartExtract:
 
+    # Extracting never needs anything we build so it can happen ahead of time
+    io_bound = True
+
     def __init__(self, **build_args):
         self.build_args = build_args
 
+    def inputs(self, phase, **state):
+
+        # The tree we make depends on what was in the archive, not where it came from
+        return [
+            state.get('archive_digest'),
+            self.build_args.get('extract_include'),
+            self.build_args.get('extract_exclude'),
+        ]
+
+    def current(self, phase, **state):
+        source = state.get('source')
+
+        # Single file libraries aren't extracted anywhere
+        if source is None or 'source_fingerprint' not in state:
+            return source is not None and os.path.exists(source)
+
+        # The tree has to be the one we extracted and prepared last time
+        status = get_status(os.path.join(state['sources_dir'], '.status', '{}.json'.format(os.path.basename(source))))
+        owner = state.get('library_name')
+
+        return os.path.isdir(source) and status.get('tree') is not None \
+            and get_fingerprint(status.get('extracted'), status['tree']) == state['source_fingerprint'] \
+            and (owner is None or (status.get('prepared') or {}).get(owner) == state.get('prepare_fingerprint'))
+
+    def extractor(self, archive):
+        if archive.endswith('.zip'):
+            return ZipExtract(**self.build_args)
+        elif TarExtract.handles(archive):
+            return TarExtract(**self.build_args)
+        else:
+            return None
+
+    def stage(self, dest):
+        # We extract next to where the source is going so putting it in place is just a rename
+        staged = os.path.join(os.path.dirname(dest), '.{}.extracting'.format(os.path.basename(dest)))
+
+        # Anything here is left over from an extraction that never finished
+        shutil.rmtree(staged, ignore_errors=True)
+        os.makedirs(staged)
+
+        return staged
+
+    def publish(self, staged, dest):
+        old = os.path.join(os.path.dirname(dest), '.{}.old'.format(os.path.basename(dest)))
+        shutil.rmtree(old, ignore_errors=True)
+
+        # Swap the new tree in, the old one is only deleted once it is out of the way
+        if os.path.exists(dest):
+            os.rename(dest, old)
+        os.rename(staged, dest)
+
+        shutil.rmtree(old, ignore_errors=True)
+
+    def tee(self, path, **state):
+        # Only tars can be extracted from a stream, zips keep their index at the end
+        if TarExtract.handles(path):
+            extractor = TarExtract(**self.build_args)
+            return extractor.tee(path, self.stage(extractor.destination(path, state['sources_dir'])))
+
+        return None
+
     def extract(self, **state):
 
         # If we have an archive
-        if 'archive' in state:
+        if 'archive' not in state:
+            raise Exception('No archive was found to extract')
+
+        archive = state['archive']
+        extractor = self.extractor(archive)
+
+        # This isn't a known archive format, its probably a single file library
+        if extractor is None:
+            return {'source': archive}
+
+        dest = extractor.destination(archive, state['sources_dir'])
+        status_path = os.path.join(state['sources_dir'], '.status', '{}.json'.format(os.path.basename(dest)))
+
+        # What we extract only depends on what is in the archive and which parts of it we want
+        key = {
+            'archive': state.get('archive_digest') or get_file_digest(archive),
+            'include': self.build_args.get('extract_include'),
+            'exclude': self.build_args.get('extract_exclude'),
+        }
+
+        # The tree is shared with other libraries that do different things to it, we only start again from a clean tree
+        # when what we do to it has changed (so a changed patch isn't applied on top of the old one)
+        status = get_status(status_path)
+        owner = state.get('library_name')
+        fingerprint = state.get('prepare_fingerprint')
+        prepared = status.get('prepared') or {}
+        unchanged = owner is None or prepared.get(owner, fingerprint) == fingerprint
 
-            if state['archive'].endswith('.zip'):
-                return ZipExtract(**self.build_args).extract(**state)
-            elif state['archive'].endswith(('.tgz', '.tar.gz', '.txz', '.tar.xz', '.tbz ', '.tbz2 ', '.tar.bz2')):
-                return TarExtract(**self.build_args).extract(**state)
-            else:
-                # This isn't a known archive format, its probably a single file library
-                return {'source': state['archive']}
+        # If our archive was already extracted as it downloaded it just needs putting in place
+        if state.get('extracted_archive') == archive:
+            staged = state['source']
+
+        elif status.get('extracted') == key and status.get('tree') is not None and unchanged and os.path.isdir(dest):
+            cprint(
+                indent('Archive {} already extracted... Skipping...'.format(os.path.basename(archive)), 8),
+                'yellow',
+                attrs=['bold']
+            )
+
+            if owner is not None:
+                update_status(status_path, {'prepared': dict(prepared, **{owner: fingerprint})})
+
+            return {'source': dest, 'source_fingerprint': get_fingerprint(key, status['tree'])}
 
         else:
-            raise Exception('No archive was found to extract')
+            cprint(
+                indent('Extracting {} to {}'.format(os.path.basename(archive), dest), 8), 'green', attrs=['bold']
+            )
+            staged = self.stage(dest)
+            extractor.extract(staged, **state)
+
+        # Until the new tree is in place there is nothing we can trust
+        update_status(status_path, {'extracted': None, 'tree': None, 'prepared': None})
+        self.publish(staged, dest)
+
+        # Every tree we extract is new, so nothing anyone did to the last one counts as done to this one
+        tree = uuid.uuid4().hex
+        update_status(
+            status_path, {
+                'extracted': key,
+                'tree': tree,
+                'prepared': {owner: fingerprint} if owner is not None else {},
+            }
+        )
+
+        return {'source': dest, 'source_fingerprint': get_fingerprint(key, tree)}
@@ -1,44 +1,223 @@
 #!/usr/bin/env python3
 
 import os
+import shutil
 import tarfile
+import threading
+import subprocess
+from contextlib import contextmanager
 from termcolor import cprint
 from tqdm import tqdm
 
-from ..util import indent
+from ..util import indent, is_sequence, is_selected
 
 
 class TarExtract:
 
+    # Decompressors that can use every core, the first one we have installed is used
+    DECOMPRESSORS = [
+        (('.tar.xz', '.txz'), [['xz', '-d', '-c', '-T0']]),
+        (('.tar.gz', '.tgz'), [['pigz', '-d', '-c']]),
+        (('.tar.bz2', '.tbz', '.tbz2'), [['pbzip2', '-d', '-c'], ['lbzip2', '-d', '-c']]),
+    ]
+
+    class Tee:
+
+        def __init__(self, f, dest):
+            self.f = f
+            self.dest = dest
+            self.source = None
+            self.error = None
+
+        def write(self, data):
+            # If the extraction falls over we keep downloading anyway
+            if self.f is not None:
+                try:
+                    self.f.write(data)
+                except OSError:
+                    self.close()
+
+        def close(self):
+            if self.f is not None:
+                try:
+                    self.f.close()
+                except OSError:
+                    pass
+                self.f = None
+
+        def discard(self):
+            self.source = None
+            shutil.rmtree(self.dest, ignore_errors=True)
+
     def __init__(self, **build_args):
-        pass
 
-    def extract(self, **state):
+        # Which parts of the archive we want (everything if we aren't told), and which we don't
+        self.include = build_args.get('extract_include', [])
+        self.include = self.include if is_sequence(self.include) else [self.include]
+        self.exclude = build_args.get('extract_exclude', [])
+        self.exclude = self.exclude if is_sequence(self.exclude) else [self.exclude]
 
-        # Get our archive and output location
-        archive = state['archive']
+    @staticmethod
+    def handles(archive):
+        return archive.endswith(('.tgz', '.tar.gz', '.txz', '.tar.xz', '.tbz', '.tbz2', '.tar.bz2'))
+
+    def destination(self, archive, sources_dir):
         basename = os.path.basename(archive)
-        dest = os.path.join(state['sources_dir'], basename[:basename.rindex('.t')])
+        return os.path.join(sources_dir, basename[:basename.rindex('.t')])
+
+    @contextmanager
+    def stream(self, archive, f):
+
+        command = None
+        for extensions, commands in TarExtract.DECOMPRESSORS:
+            if archive.endswith(extensions):
+                command = next((c for c in commands if shutil.which(c[0]) is not None), None)
+
+        # Without one we let python decompress it for us
+        if command is None:
+            with tarfile.open(fileobj=f, mode='r|*') as tf:
+                yield tf
+            return
+
+        process = subprocess.Popen(command, stdin=f, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        failed = False
+
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tf:
+                yield tf
+
+            # Drain anything after the end of the tar so the decompressor can finish
+            while process.stdout.read(1024 * 1024):
+                pass
+
+        except BaseException:
+            failed = True
+            raise
+
+        finally:
+            process.stdout.close()
+            error = process.stderr.read()
+            process.stderr.close()
+            process.wait()
+
+            # If we stopped reading early the decompressor will have been killed, that isn't its fault. If something
+            # else went wrong that is what we report
+            if process.returncode > 0 and not failed:
+                raise Exception(
+                    'Failed to decompress {}: {}'.format(archive, error.decode('utf-8', 'replace').strip())
+                )
+
+    @contextmanager
+    def tee(self, path, dest):
+
+        cprint(indent('Extracting {} as it downloads'.format(os.path.basename(path)), 8), 'green', attrs=['bold'])
+
+        read_fd, write_fd = os.pipe()
+        writer = TarExtract.Tee(os.fdopen(write_fd, 'wb'), dest)
+
+        def extract():
+            try:
+                with os.fdopen(read_fd, 'rb') as f:
+                    with self.stream(path, f) as tf:
+                        self.unpack(tf, dest)
+
+                    # Keep reading whatever is after the end of the tar so the download is never blocked
+                    while f.read(1024 * 1024):
+                        pass
+
+                writer.source = dest
+
+            except Exception as e:
+                writer.error = e
+
+        thread = threading.Thread(target=extract)
+        thread.start()
+
+        try:
+            yield writer
+
+        finally:
+            writer.close()
+            thread.join()
+
+            # A half extracted tree is no use to anyone, the extract phase will do it properly from the archive
+            if writer.source is None:
+                cprint(
+                    indent(
+                        'Failed to extract {} as it downloaded: {}'.format(os.path.basename(path), writer.error), 8
+                    ),
+                    'yellow',
+                    attrs=['bold']
+                )
+                writer.discard()
+
+    def extract(self, dest, **state):
+        archive = state['archive']
+
+        with open(archive, 'rb') as f, self.stream(archive, f) as tf:
+            self.unpack(tf, dest)
+
+    def unpack(self, tf, dest):
+
+        os.makedirs(dest, exist_ok=True)
+
+        with tqdm(unit='files') as progress:
+
+            # We only read the archive once so we can't find the common prefix before we start. Instead assume the top
+            # level folder of the first entry is the prefix, and if we are proven wrong put it back
+            prefix = None
+            count = 0
+
+            # Files we left out, anything hard linked to them has to be left out too
+            skipped = set()
+
+            for f in tf:
+                name = os.path.normpath(f.name)
+
+                # Some archives list their root folder as ./
+                if name == os.curdir:
+                    continue
+
+                if count == 0 and (f.isdir() or os.sep in name):
+                    prefix = name.split(os.sep)[0]
+
+                count += 1
+                if count % 256 == 0:
+                    progress.update(256)
+
+                if prefix is not None and name != prefix and not name.startswith(prefix + os.sep):
+                    relocate(dest, prefix)
+                    skipped = set(os.path.join(prefix, s) for s in skipped)
+                    prefix = None
+
+                # Remove the common prefix and extract
+                if prefix is not None:
+                    if name == prefix:
+                        continue
+                    f.name = os.path.relpath(name, prefix)
 
-        # If our archive is newer than our folder extract
-        if not os.path.exists(dest) or os.path.getmtime(archive) >= os.path.getmtime(dest):
-            cprint(indent('Extracting {} to {}'.format(basename, dest), 8), 'green', attrs=['bold'])
-            with tarfile.open(archive, 'r') as tf:
+                    # Hard links point at other files in the archive so they need moving too
+                    if f.islnk():
+                        f.linkname = os.path.relpath(os.path.normpath(f.linkname), prefix)
 
-                # Find the leading directory prefix
-                prefix = os.path.commonpath([n.name for n in tf.getmembers()])
+                # Skip anything we don't want without ever writing it
+                if not is_selected(os.path.normpath(f.name), self.include, self.exclude) \
+                   or (f.islnk() and os.path.normpath(f.linkname) in skipped):
+                    if not f.isdir():
+                        skipped.add(os.path.normpath(f.name))
+                    continue
 
-                for f in tqdm(tf.getmembers(), unit='files'):
+                tf.extract(f, dest)
 
-                    # Remove the common prefix and extract
-                    if f.name is not prefix:
-                        f.name = os.path.relpath(f.name, prefix)
-                        tf.extract(f, dest)
+            progress.update(count % 256)
 
-            # Touch the folder.
-            os.utime(dest)
+        # Touch the folder.
+        os.utime(dest)
 
-        else:
-            cprint(indent('Archive {} already extracted... Skipping...'.format(basename), 8), 'yellow', attrs=['bold'])
 
-        return {'source': dest}
+def relocate(dest, prefix):
+    # Everything we have extracted so far really belonged inside prefix
+    tmp = '{}.{}'.format(dest, os.getpid())
+    os.rename(dest, tmp)
+    os.makedirs(dest)
+    os.rename(tmp, os.path.join(dest, prefix))
@@ -1,46 +1,93 @@
 #!/usr/bin/env python3
 
 import os
+import stat
+import shutil
 import zipfile
-from termcolor import cprint
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-from ..util import indent
+from ..util import is_sequence, is_selected
 
 
 class ZipExtract:
 
     def __init__(self, **build_args):
-        pass
 
-    def extract(self, **state):
+        # Which parts of the archive we want (everything if we aren't told), and which we don't
+        self.include = build_args.get('extract_include', [])
+        self.include = self.include if is_sequence(self.include) else [self.include]
+        self.exclude = build_args.get('extract_exclude', [])
+        self.exclude = self.exclude if is_sequence(self.exclude) else [self.exclude]
 
-        # Get our archive and output location
-        archive = state['archive']
+    def destination(self, archive, sources_dir):
         basename = os.path.basename(archive)
-        dest = os.path.join(state['sources_dir'], basename[:basename.rindex('.zip')])
+        return os.path.join(sources_dir, basename[:basename.rindex('.zip')])
+
+    def extract(self, dest, **state):
+        archive = state['archive']
+
+        with zipfile.ZipFile(archive, 'r') as zf, ExitStack() as stack:
+            members = zf.infolist()
+
+            # Find the leading directory prefix
+            names = [m.filename.rstrip('/') for m in members]
+            prefix = os.path.commonpath(names) if len(names) > 1 else os.path.dirname(''.join(names))
+
+            # Remove the common prefix, leaving out anything we were asked not to extract
+            paths = {}
+            for m in members:
+                path = os.path.relpath(m.filename.rstrip('/'), prefix) if prefix else m.filename.rstrip('/')
+                if path != os.curdir and is_selected(path, self.include, self.exclude):
+                    paths[m] = os.path.join(dest, path)
+
+            directories = [m for m in paths if m.is_dir()]
+            files = [m for m in paths if not m.is_dir()]
+
+            # Make all the folders up front so the files can be written in any order
+            os.makedirs(dest, exist_ok=True)
+            for m in directories:
+                os.makedirs(paths[m], exist_ok=True)
+
+            # Every member is compressed on its own so we can decompress as many at once as we have jobs for
+            jobs = stack.enter_context(state['jobserver'].acquire()) if 'jobserver' in state else os.cpu_count()
+
+            with tqdm(total=len(files), unit='files') as progress, ThreadPoolExecutor(max_workers=jobs) as pool:
+                for _ in pool.map(lambda m: write_member(zf, m, paths[m]), files):
+                    progress.update()
+
+            # Folder permissions go last in case they stop us writing into them
+            for m in directories:
+                mode = unix_mode(m)
+                if mode is not None:
+                    os.chmod(paths[m], stat.S_IMODE(mode))
+
+        # Touch the folder.
+        os.utime(dest)
+
+
+def unix_mode(member):
+    # Zips made on unix keep the file's mode in the top half of external_attr
+    mode = member.external_attr >> 16
+    return mode if member.create_system == 3 and mode != 0 else None
 
-        # If our archive is newer than our folder extract
-        if not os.path.exists(dest) or os.path.getmtime(archive) >= os.path.getmtime(dest):
-            cprint(indent('Extracting {} to {}'.format(basename, dest), 8), 'green', attrs=['bold'])
-            with zipfile.ZipFile(archive, 'r') as zf:
 
-                # Find the leading directory prefix
-                prefix = os.path.commonpath(zf.namelist())
+def write_member(zf, member, path):
 
-                for f in tqdm(zf.namelist(), unit='files'):
+    mode = unix_mode(member)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
 
-                    # Remove the common prefix and extract
-                    if f is not prefix:
-                        dest_file = os.path.join(dest, os.path.relpath(f, prefix))
-                        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
-                        with open(dest_file, 'wb') as f:
-                            f.write(zf.read(f))
+    if os.path.lexists(path):
+        os.unlink(path)
 
-            # Touch the folder.
-            os.utime(dest)
+    # A symlink is stored as a file containing where it points
+    if mode is not None and stat.S_ISLNK(mode):
+        os.symlink(zf.read(member).decode('utf-8'), path)
+        return
 
-        else:
-            cprint(indent('Archive {} already extracted... Skipping...'.format(basename), 8), 'yellow', attrs=['bold'])
+    with zf.open(member) as src, open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
 
-        return {'source': dest}
+    if mode is not None:
+        os.chmod(path, stat.S_IMODE(mode))
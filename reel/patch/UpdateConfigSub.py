@@ -1,32 +1,129 @@
 #!/usr/bin/env python3
 
-import requests
 import os
 import stat
+import time
+import hashlib
+import threading
 from termcolor import cprint
 
-from ..util import get_status, update_status, indent
+from ..download import HTTPClient
+from ..util import get_status, update_status, is_complete, set_complete, indent, lock, get_lock_path
 
-# Grab the latest config.sub from the intertubes
-req = requests.get('https://raw.githubusercontent.com/gcc-mirror/gcc/master/config.sub', allow_redirects=True)
 
-config_sub_file = req.content
+class UpdateConfigSub:
 
+    # Where we grab the latest config.sub from the intertubes
+    URL = 'https://raw.githubusercontent.com/gcc-mirror/gcc/{}/config.sub'
 
-class UpdateConfigSub:
+    # How long a config.sub from a branch is good for before we look for a newer one (a day)
+    TTL = 24 * 60 * 60
+
+    # Patching only touches the source tree so it can happen ahead of time
+    io_bound = True
+
+    # The config.sub files we have already loaded, shared by every library using us
+    _config_subs = {}
+    _lock = threading.Lock()
 
     def __init__(self, **build_args):
         self.path = build_args.get('config_sub_file', 'config.sub')
 
+        # Which revision of gcc's config.sub to use, and optionally the sha256 it must have
+        self.revision = build_args.get('config_sub_revision', 'master')
+        self.sha256 = build_args.get('config_sub_sha256')
+
+    def inputs(self, phase, **state):
+
+        return [self.path, self.revision, self.sha256]
+
+    def config_sub(self, **state):
+
+        # Different libraries can pin the same revision to different files, so each pin gets its own copy
+        key = (self.revision, self.sha256.lower() if self.sha256 is not None else None)
+
+        with UpdateConfigSub._lock:
+            if key not in UpdateConfigSub._config_subs:
+                UpdateConfigSub._config_subs[key] = self.fetch(**state)
+
+            return UpdateConfigSub._config_subs[key]
+
+    def fetch(self, **state):
+
+        cache_dir = os.path.join(state['setup_dir'], 'config_sub', self.revision)
+        cache_file = os.path.join(cache_dir, 'config.sub')
+        status_path = os.path.join(cache_dir, 'status.json')
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Every toolchain shares the one copy on disk
+        with lock(get_lock_path(cache_file, **state)):
+            config_sub = self.load(cache_file, status_path, False, **state)
+
+            # What we had might just be old or broken, so throw it away and fetch it once more before giving up
+            if not self.verify(config_sub):
+                os.remove(cache_file)
+                update_status(status_path, {'fetched': 0})
+                config_sub = self.load(cache_file, status_path, True, **state)
+
+            if not self.verify(config_sub):
+                raise Exception(
+                    'Checksum mismatch for config.sub revision {}: expected {} but got {}'.format(
+                        self.revision, self.sha256, hashlib.sha256(config_sub).hexdigest()
+                    )
+                )
+
+            return config_sub
+
+    def verify(self, config_sub):
+        return self.sha256 is None or hashlib.sha256(config_sub).hexdigest() == self.sha256.lower()
+
+    def load(self, cache_file, status_path, refetch, **state):
+
+        status = get_status(status_path)
+        cached = os.path.isfile(cache_file)
+
+        # A branch moves so we check it again after a while, anything else is fixed forever
+        pinned = self.sha256 is not None or self.revision != 'master'
+        fresh = cached and (pinned or time.time() - status.get('fetched', 0) < UpdateConfigSub.TTL)
+
+        if not fresh and not state.get('offline', False):
+            try:
+                req = HTTPClient.get(UpdateConfigSub.URL.format(self.revision))
+                req.raise_for_status()
+
+                # Write it somewhere else first, so nobody ever finds half a config.sub
+                tmp_file = '{}.part'.format(cache_file)
+                with open(tmp_file, 'wb') as f:
+                    f.write(req.content)
+                os.replace(tmp_file, cache_file)
+
+                update_status(status_path, {'fetched': time.time()})
+                cached = True
+
+            except Exception as e:
+                # An old config.sub is much better than no config.sub
+                if not cached or refetch:
+                    raise
+
+                cprint(
+                    indent('Failed to update config.sub ({}), using the one we already have'.format(e), 8),
+                    'yellow',
+                    attrs=['bold']
+                )
+
+        if not cached:
+            raise Exception('No config.sub for revision {} has been downloaded'.format(self.revision))
+
+        with open(cache_file, 'rb') as f:
+            return f.read()
+
     def post_extract(self, **state):
 
         src_path = os.path.basename(state['source'])
         status_path = os.path.join(state['status_dir'], '{}.json'.format(src_path))
 
-        # Load the status file.
-        status = get_status(status_path)
-
-        if 'config_sub' not in status or not status['config_sub']:
+        if not is_complete(status_path, 'config_sub', **state):
 
             cprint(indent('Patching {} for {}'.format(self.path, src_path), 8), 'green', attrs=['bold'])
 
@@ -37,9 +134,9 @@ class UpdateConfigSub:
                 os.chmod(dest_file, os.stat(dest_file).st_mode | stat.S_IWUSR)
 
             with open(dest_file, 'wb') as f:
-                f.write(config_sub_file)
+                f.write(self.config_sub(**state))
 
-            update_status(status_path, {'config_sub': True})
+            set_complete(status_path, 'config_sub', **state)
 
         else:
             cprint(
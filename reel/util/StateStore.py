@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sqlite3
+import threading
+
+
+class StateStore:
+
+    # The store every status goes to once a toolchain has opened one
+    _current = None
+
+    def __init__(self, path):
+
+        # Every status is keyed by its old status file path relative to the folder the database lives in
+        self.path = os.path.abspath(path)
+        self.root = os.path.dirname(self.path)
+
+        # One connection per process, shared by all of our threads one at a time
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    @staticmethod
+    def open(path):
+        if StateStore._current is None or StateStore._current.path != os.path.abspath(path):
+            StateStore._current = StateStore(path)
+
+        return StateStore._current
+
+    @staticmethod
+    def current():
+        return StateStore._current
+
+    def connection(self):
+
+        # Connections can't be shared with processes we fork, so each process makes its own
+        if self._pid != os.getpid():
+            os.makedirs(self.root, exist_ok=True)
+
+            # Autocommit so we control exactly where transactions start and end
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS status (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def key(self, status_file):
+        return os.path.relpath(os.path.abspath(status_file), self.root)
+
+    def read(self, connection, status_file):
+
+        # Deleting a status folder has always been how to start everything in it again from scratch
+        folder = os.path.dirname(os.path.abspath(status_file))
+        if not os.path.isdir(folder):
+            self.forget(connection, folder)
+            return {}
+
+        row = connection.execute('SELECT value FROM status WHERE key = ?', (self.key(status_file), )).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+
+        # Bring in status files written before we had a store, they are removed once they are in the database
+        if os.path.isfile(status_file):
+            with open(status_file, 'r') as f:
+                return json.load(f)
+
+        return {}
+
+    def write(self, connection, status_file, status):
+        # Our statuses live in the database, but their folder is still what says they haven't been thrown away
+        os.makedirs(os.path.dirname(os.path.abspath(status_file)), exist_ok=True)
+        connection.execute(
+            'INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)',
+            (self.key(status_file), json.dumps(status, sort_keys=True)),
+        )
+
+    def transaction(self, connection, status_file, args):
+
+        # Take the write lock up front so nobody can change the status between us reading and writing it
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            status = self.read(connection, status_file)
+            status.update(args)
+            self.write(connection, status_file, status)
+            connection.execute('COMMIT')
+
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        if os.path.isfile(status_file):
+            os.remove(status_file)
+
+        return status
+
+    def get(self, status_file):
+        with self._lock:
+            connection = self.connection()
+
+            # Status files we haven't migrated yet are imported by writing them back
+            if os.path.isfile(status_file):
+                return self.transaction(connection, status_file, {})
+
+            return self.read(connection, status_file)
+
+    def update(self, status_file, args):
+        with self._lock:
+            return self.transaction(self.connection(), status_file, args)
+
+    def forget(self, connection, path):
+        key = self.key(path)
+        connection.execute(
+            "DELETE FROM status WHERE key = ? OR key LIKE ? ESCAPE '\\'",
+            (key, '{}/%'.format(key.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))),
+        )
+
+    def remove(self, path):
+        # Forget everything that was stored under a folder we deleted
+        with self._lock:
+            self.forget(self.connection(), path)
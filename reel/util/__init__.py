@@ -2,7 +2,21 @@
 
 import os
 import json
+import stat
+import fcntl
+import shutil
+import hashlib
+import fnmatch
+import tempfile
 import textwrap
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from .StateStore import StateStore
+
+# The ioctl that makes a file share another file's data until one of them is written to (from linux/fs.h)
+FICLONE = 0x40049409
 
 
 def indent(s, length=4):
@@ -14,6 +28,11 @@ def dedent(s):
 
 
 def get_status(status_file):
+    # Use the state store if we have one
+    store = StateStore.current()
+    if store is not None:
+        return store.get(status_file)
+
     # Make sure the status directory exists.
     os.makedirs(os.path.dirname(status_file), exist_ok=True)
 
@@ -36,16 +55,92 @@ def get_paths(build_postfix, **state):
     return src_path, base_src, logs_path, build_path, status_path
 
 
+def get_file_digest(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def get_url_status_path(url, **state):
+    split = urlsplit(url)
+    return '{}.json'.format(os.path.join(state['archives_dir'], 'status', split.netloc, split.path[1:]))
+
+
 def update_status(status_file, args):
+    store = StateStore.current()
+    if store is not None:
+        return store.update(status_file, args)
+
     status = get_status(status_file)
     status.update(args)
 
-    with open(status_file, 'w') as f:
-        json.dump(status, f, indent=4, separators=(',', ': '), sort_keys=True)
+    # Write it somewhere else first, so a build that stops part way through never leaves half a status file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(status_file), suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f, indent=4, separators=(',', ': '), sort_keys=True)
+        os.replace(tmp, status_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
     return status
 
 
+def get_fingerprint(*inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_env_changes(env):
+    # Only the environment we add matters, the rest of it is whatever machine we happen to be running on
+    changes = {}
+
+    for k, v in env.items():
+        inherited = os.environ.get(k)
+
+        if inherited != v:
+            # Where we add our own folders to what the machine had (like PATH) only the part we added counts
+            if inherited and v.startswith(inherited + os.pathsep):
+                v = '${{{}}}{}'.format(k, v[len(inherited):])
+            elif inherited and v.endswith(os.pathsep + inherited):
+                v = '{}${{{}}}'.format(v[:-len(inherited)], k)
+
+            changes[k] = v
+
+    return changes
+
+
+def is_complete(status_path, step, **state):
+    # A step is only complete if it was done with exactly the same inputs as we have now
+    return get_status(status_path).get(step) == state.get('fingerprint', True)
+
+
+def set_complete(status_path, step, **state):
+    return update_status(status_path, {step: state.get('fingerprint', True)})
+
+
+@contextmanager
+def lock(lock_file, shared=False):
+    # Make sure the lock directory exists.
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+
+    # flock works between processes and between threads as each call opens its own file
+    with open(lock_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_lock_path(key, **state):
+    return os.path.join(state['setup_dir'], 'lock', '{}.lock'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+
 def is_sequence(item):
     if isinstance(item, (str, bytes)):
         return False
@@ -55,6 +150,78 @@ def is_sequence(item):
         return False
 
 
+def is_selected(path, include=(), exclude=()):
+    # A pattern that matches a folder matches everything inside it too
+    parts = path.split(os.sep)
+    paths = [os.sep.join(parts[:i + 1]) for i in range(len(parts))]
+
+    def matches(patterns):
+        return any(fnmatch.fnmatchcase(p, pattern) for p in paths for pattern in patterns)
+
+    return (not include or matches(include)) and not matches(exclude)
+
+
+def clone_file(src, dest):
+
+    # Never write into whatever is already here, it could be a hard link to our source
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    mode = os.lstat(src).st_mode
+
+    if stat.S_ISLNK(mode):
+        os.symlink(os.readlink(src), dest)
+        return
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+
+    if not cloned:
+        # Nobody can write to a read only file without replacing it first, so it is safe to share it with the source
+        if not mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+            try:
+                os.unlink(dest)
+                os.link(src, dest)
+                return
+            except OSError:
+                pass
+
+        shutil.copyfile(src, dest)
+
+    shutil.copystat(src, dest)
+
+
+def clone_tree(src, dest, jobs=None):
+
+    folders = []
+    files = []
+
+    for root, dirs, names in os.walk(src):
+        target = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+        os.makedirs(target, exist_ok=True)
+        folders.append((root, target))
+
+        # Links to folders are cloned as links, not followed
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        dirs[:] = [d for d in dirs if d not in links]
+
+        files.extend((os.path.join(root, n), os.path.join(target, n)) for n in names + links)
+
+    with ThreadPoolExecutor(max_workers=jobs if jobs is not None else os.cpu_count()) as pool:
+        for _ in pool.map(lambda f: clone_file(*f), files):
+            pass
+
+    # Folders go last so filling them doesn't change their times, and read only folders don't stop us filling them
+    for root, target in reversed(folders):
+        shutil.copystat(root, target)
+
+    return len(files)
+
+
 def parse_args(dict_args, **state):
     args = []
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from reel.download.HTTPDownload import HTTPDownload
+from reel.util import StateStore, get_status, get_url_status_path
+
+
+class Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+
+        # What we serve, and the requests we were sent for it
+        self.data = os.urandom(64 * 1024)
+        self.etag = '"v1"'
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        # Downloads hang up on responses they don't need, that isn't a problem
+        pass
+
+    def url(self, name='pkg-1.0.tar.gz'):
+        return 'http://127.0.0.1:{}/{}'.format(self.server_address[1], name)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        data = server.data
+        status = 200
+
+        # Only send part of the file if it is still the one that was asked about
+        requested = self.headers.get('Range')
+        if requested and self.headers.get('If-Range', server.etag) == server.etag:
+            start, end = requested[len('bytes='):].split('-')
+            end = int(end) if end else len(data) - 1
+            data = data[int(start):end + 1]
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', server.etag)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(server.data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        StateStore._current = None
+
+        self.root = tempfile.mkdtemp()
+        self.state = {'archives_dir': os.path.join(self.root, 'archive'), 'setup_dir': self.root}
+        os.makedirs(self.state['archives_dir'])
+
+        self.server = Server()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.output_file = os.path.join(self.state['archives_dir'], 'pkg-1.0.tar.gz')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def download(self, **build_args):
+        return HTTPDownload(url=self.server.url(), **build_args).download(**self.state)
+
+    def assertDownloaded(self, result):
+        sha256 = hashlib.sha256(self.server.data).hexdigest()
+
+        self.assertEqual(result, {'archive': self.output_file, 'archive_digest': sha256})
+        with open(self.output_file, 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
+
+        # Nothing is left over from getting it (the status folder is where we remember it)
+        self.assertEqual(sorted(os.listdir(self.state['archives_dir'])), ['pkg-1.0.tar.gz', 'status'])
+
+    def partial(self, size, layout):
+        with open('{}.part0'.format(self.output_file), 'wb') as f:
+            f.write(self.server.data[:size])
+
+        with open('{}.parts'.format(self.output_file), 'w') as f:
+            json.dump(layout, f)
+
+
+class TestDownload(DownloadTest):
+
+    def test_download(self):
+        self.assertDownloaded(self.download())
+
+        status = get_status(get_url_status_path(self.server.url(), **self.state))
+        self.assertTrue(status['downloaded'])
+        self.assertEqual(status['etag'], self.server.etag)
+        self.assertEqual(status['sha256'], hashlib.sha256(self.server.data).hexdigest())
+
+    def test_not_modified(self):
+        self.download()
+        self.assertDownloaded(self.download())
+
+        self.assertEqual(self.server.requests[-1].get('If-None-Match'), self.server.etag)
+
+    def test_offline_trusts_what_we_have(self):
+        self.download()
+        self.state['offline'] = True
+        self.assertDownloaded(self.download())
+
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_resume(self):
+        size = len(self.server.data)
+        self.partial(1000, {'validator': self.server.etag, 'size': size, 'segments': [[0, size - 1]]})
+
+        self.assertDownloaded(self.download())
+
+        # The first response is only used to find out about the file, the rest is asked for from where we got to
+        self.assertEqual(self.server.requests[-1]['Range'], 'bytes=1000-{}'.format(size - 1))
+        self.assertEqual(self.server.requests[-1]['If-Range'], self.server.etag)
+
+    def test_changed_file_starts_again(self):
+        size = len(self.server.data)
+        self.partial(1000, {'validator': '"v0"', 'size': size, 'segments': [[0, size - 1]]})
+
+        self.assertDownloaded(self.download())
+        self.assertNotIn('Range', self.server.requests[-1])
+
+    def test_different_segments_start_again(self):
+        size = len(self.server.data)
+        self.partial(1000, {'validator': self.server.etag, 'size': size, 'segments': [[0, 999], [1000, size - 1]]})
+
+        self.assertDownloaded(self.download())
+        self.assertNotIn('Range', self.server.requests[-1])
+
+    def test_segments(self):
+        threshold = HTTPDownload.SEGMENT_THRESHOLD
+        HTTPDownload.SEGMENT_THRESHOLD = 0
+        self.addCleanup(setattr, HTTPDownload, 'SEGMENT_THRESHOLD', threshold)
+
+        self.state['download_segments'] = 4
+        self.assertDownloaded(self.download())
+
+        size = len(self.server.data)
+        self.assertEqual(
+            sorted(r['Range'] for r in self.server.requests if 'Range' in r),
+            sorted('bytes={}-{}'.format(s, s + size // 4 - 1) for s in range(0, size, size // 4)),
+        )
+
+
+class TestChecksum(DownloadTest):
+
+    def test_pinned_match_skips_the_server(self):
+        sha256 = hashlib.sha256(self.server.data).hexdigest()
+        self.download(sha256=sha256)
+        self.assertDownloaded(self.download(sha256=sha256.upper()))
+
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_pinned_mismatch_downloads_again(self):
+        self.download()
+
+        # The archive we have is an old one, the server has moved on to the one we are now pinned to
+        self.server.data = os.urandom(1024)
+        self.server.etag = '"v2"'
+
+        self.assertDownloaded(self.download(sha256=hashlib.sha256(self.server.data).hexdigest()))
+        self.assertNotIn('If-None-Match', self.server.requests[-1])
+
+    def test_wrong_archive_is_never_kept(self):
+        with self.assertRaises(Exception):
+            self.download(sha256='0' * 64)
+
+        self.assertFalse(os.path.exists(self.output_file))
+        self.assertFalse(get_status(get_url_status_path(self.server.url(), **self.state)).get('downloaded', False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import stat
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+from reel.Jobserver import Jobserver
+from reel.extract.TarExtract import TarExtract
+from reel.extract.ZipExtract import ZipExtract
+
+
+def add(tf, name, data=None, **info):
+    member = tarfile.TarInfo(name)
+
+    for k, v in info.items():
+        setattr(member, k, v)
+
+    if data is not None:
+        member.size = len(data)
+        tf.addfile(member, io.BytesIO(data))
+    else:
+        tf.addfile(member)
+
+
+class ExtractTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dest = os.path.join(self.root, 'src', 'pkg-1.0')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def files(self):
+        found = []
+        for root, dirs, names in os.walk(self.dest):
+            found.extend(os.path.relpath(os.path.join(root, n), self.dest) for n in dirs + names)
+
+        return sorted(found)
+
+    def read(self, path):
+        with open(os.path.join(self.dest, path), 'rb') as f:
+            return f.read()
+
+
+class TestTarExtract(ExtractTest):
+
+    def tar(self, build, name='pkg-1.0.tar.gz'):
+        archive = os.path.join(self.root, name)
+        with tarfile.open(archive, 'w:gz') as tf:
+            build(tf)
+
+        return archive
+
+    def extract(self, archive, **build_args):
+        TarExtract(**build_args).extract(self.dest, archive=archive)
+
+    def test_destination(self):
+        self.assertEqual(TarExtract().destination('/a/pkg-1.0.tar.xz', '/src'), '/src/pkg-1.0')
+        self.assertTrue(TarExtract.handles('pkg.tbz2'))
+        self.assertFalse(TarExtract.handles('pkg.zip'))
+
+    def test_prefix_is_removed(self):
+        def build(tf):
+            add(tf, 'pkg-1.0', type=tarfile.DIRTYPE)
+            add(tf, 'pkg-1.0/configure', b'#!/bin/sh\n', mode=0o755)
+            add(tf, 'pkg-1.0/src/main.c', b'int main;\n')
+
+        self.extract(self.tar(build))
+
+        self.assertEqual(self.files(), ['configure', 'src', 'src/main.c'])
+        self.assertTrue(os.access(os.path.join(self.dest, 'configure'), os.X_OK))
+
+    def test_prefix_put_back_when_wrong(self):
+        def build(tf):
+            add(tf, 'pkg-1.0/configure', b'#!/bin/sh\n')
+            add(tf, 'README', b'readme')
+
+        self.extract(self.tar(build))
+
+        self.assertEqual(self.files(), ['README', 'pkg-1.0', 'pkg-1.0/configure'])
+
+    def test_hard_links_follow_the_prefix(self):
+        def build(tf):
+            add(tf, 'pkg-1.0/a', b'data')
+            add(tf, 'pkg-1.0/b', type=tarfile.LNKTYPE, linkname='pkg-1.0/a')
+
+        self.extract(self.tar(build))
+
+        self.assertEqual(self.read('b'), b'data')
+
+    def test_skipped_links_stay_skipped(self):
+        def build(tf):
+            add(tf, 'pkg-1.0/doc/a', b'data')
+            add(tf, 'pkg-1.0/b', type=tarfile.LNKTYPE, linkname='pkg-1.0/doc/a')
+
+        self.extract(self.tar(build), extract_exclude='doc')
+
+        self.assertEqual(self.files(), [])
+
+    def test_skipped_links_stay_skipped_after_relocating(self):
+        def build(tf):
+            add(tf, 'pkg-1.0/doc/a', b'data')
+            add(tf, 'other', b'other')
+            add(tf, 'pkg-1.0/b', type=tarfile.LNKTYPE, linkname='pkg-1.0/doc/a')
+
+        # Until other turns up doc/a looks like it is inside the common prefix, so that is where it is excluded from
+        self.extract(self.tar(build), extract_exclude='doc')
+
+        self.assertEqual(self.files(), ['other', 'pkg-1.0'])
+
+    def test_include(self):
+        def build(tf):
+            add(tf, 'pkg-1.0/include/a.h', b'a')
+            add(tf, 'pkg-1.0/src/a.c', b'a')
+
+        self.extract(self.tar(build), extract_include=['include'])
+
+        self.assertEqual(self.files(), ['include', 'include/a.h'])
+
+
+class TestZipExtract(ExtractTest):
+
+    def zip(self, members):
+        archive = os.path.join(self.root, 'pkg-1.0.zip')
+
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for name, data, mode in members:
+                info = zipfile.ZipInfo(name)
+                info.create_system = 3
+                info.external_attr = mode << 16
+                zf.writestr(info, data)
+
+        return archive
+
+    def test_modes_and_symlinks(self):
+        archive = self.zip([
+            ('pkg-1.0/', b'', stat.S_IFDIR | 0o755),
+            ('pkg-1.0/configure', b'#!/bin/sh\n', stat.S_IFREG | 0o755),
+            ('pkg-1.0/README', b'readme', stat.S_IFREG | 0o644),
+            ('pkg-1.0/README.md', b'README', stat.S_IFLNK | 0o777),
+        ])
+
+        ZipExtract().extract(self.dest, archive=archive, jobserver=Jobserver(2))
+
+        self.assertEqual(self.files(), ['README', 'README.md', 'configure'])
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dest, 'configure')).st_mode), 0o755)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dest, 'README')).st_mode), 0o644)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'README.md')), 'README')
+
+    def test_zips_without_modes(self):
+        archive = os.path.join(self.root, 'pkg-1.0.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('pkg-1.0/a.txt', b'a')
+            zf.writestr('pkg-1.0/b/b.txt', b'b')
+
+        ZipExtract().extract(self.dest, archive=archive)
+
+        self.assertEqual(self.files(), ['a.txt', 'b', 'b/b.txt'])
+        self.assertEqual(self.read('b/b.txt'), b'b')
+
+    def test_exclude(self):
+        archive = self.zip([
+            ('pkg-1.0/src/a.c', b'a', stat.S_IFREG | 0o644),
+            ('pkg-1.0/doc/a.html', b'a', stat.S_IFREG | 0o644),
+        ])
+
+        ZipExtract(extract_exclude=['doc']).extract(self.dest, archive=archive)
+
+        self.assertEqual(self.files(), ['src', 'src/a.c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
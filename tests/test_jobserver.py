@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+import select
+import unittest
+
+from reel.Jobserver import Jobserver
+
+
+def tokens(jobserver):
+    # Count the tokens in the pipe by taking them all and putting them back
+    taken = b''
+    while select.select([jobserver.read_fd], [], [], 0)[0]:
+        taken += os.read(jobserver.read_fd, 1)
+
+    if taken:
+        os.write(jobserver.write_fd, taken)
+
+    return len(taken)
+
+
+class TestJobserver(unittest.TestCase):
+
+    def setUp(self):
+        self.jobserver = Jobserver(4)
+
+    def tearDown(self):
+        os.close(self.jobserver.read_fd)
+        os.close(self.jobserver.write_fd)
+
+    def test_one_token_per_job(self):
+        self.assertEqual(tokens(self.jobserver), 4)
+        self.assertEqual(Jobserver(0).jobs, 1)
+
+    def test_slot_holds_a_token(self):
+        with self.jobserver.slot():
+            self.assertEqual(self.jobserver.running, 1)
+            self.assertEqual(tokens(self.jobserver), 3)
+
+        self.assertEqual(self.jobserver.running, 0)
+        self.assertEqual(tokens(self.jobserver), 4)
+
+    def test_acquire_alone_gets_every_job(self):
+        with self.jobserver.slot(), self.jobserver.acquire() as jobs:
+            self.assertEqual(jobs, 4)
+            self.assertEqual(tokens(self.jobserver), 0)
+
+        self.assertEqual(tokens(self.jobserver), 4)
+
+    def test_acquire_takes_its_share(self):
+        with self.jobserver.slot(), self.jobserver.slot():
+            with self.jobserver.acquire() as jobs:
+                self.assertEqual(jobs, 2)
+
+                # What is left is for the other build
+                self.assertEqual(tokens(self.jobserver), 1)
+
+        self.assertEqual(tokens(self.jobserver), 4)
+
+    def test_acquire_without_free_tokens(self):
+        with self.jobserver.slot(), self.jobserver.slot(), self.jobserver.slot(), self.jobserver.slot():
+            with self.jobserver.acquire() as jobs:
+                self.assertEqual(jobs, 1)
+
+    def test_env(self):
+        env = self.jobserver.env({'MAKEFLAGS': '-j8 --jobserver-auth=3,4 -k', 'PATH': '/bin'})
+        flags = env['MAKEFLAGS'].split()
+
+        self.assertEqual(env['PATH'], '/bin')
+        self.assertNotIn('-j8', flags)
+        self.assertIn('-k', flags)
+        self.assertIn('--jobserver-auth={},{}'.format(*self.jobserver.fds), flags)
+        self.assertIn('--jobserver-fds={},{}'.format(*self.jobserver.fds), flags)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+from reel.Jobserver import Jobserver
+from reel.Scheduler import Scheduler
+
+
+class Toolchain:
+
+    def __init__(self, jobs):
+        self.state = {'jobserver': Jobserver(jobs)}
+
+
+class Library:
+
+    def __init__(self, toolchain, name, depends_on=None, duration=None, fail=False):
+        self.toolchain = toolchain
+        self.name = name
+        self.depends_on = depends_on
+        self.duration = duration
+        self.fail = fail
+
+        # What happened to us, in the order it happened to everyone
+        self.log = None
+        self.prepared = False
+
+    def estimated_duration(self):
+        return self.duration
+
+    def archive_size(self):
+        return None
+
+    def prepare(self):
+        self.prepared = True
+        return {'name': self.name}
+
+    def build(self, state, dependencies):
+        self.log.append(('start', self.name))
+        time.sleep(0.05)
+        self.log.append(('end', self.name))
+
+        if self.fail:
+            raise Exception('{} failed'.format(self.name))
+
+
+def libraries(jobs, *specs):
+    toolchain = Toolchain(jobs)
+    log = []
+    libs = []
+
+    for spec in specs:
+        l = Library(toolchain, **spec)
+        l.log = log
+        libs.append(l)
+
+    return libs, log
+
+
+def names(libs):
+    return [l.name for l in libs]
+
+
+class TestDependencies(unittest.TestCase):
+
+    def test_undeclared_waits_for_everything_before_it(self):
+        libs, _ = libraries(1, {'name': 'a'}, {'name': 'b', 'depends_on': []}, {'name': 'c'})
+        s = Scheduler(libs)
+
+        self.assertEqual(names(s.dependencies[libs[0]]), [])
+        self.assertEqual(names(s.dependencies[libs[2]]), ['a', 'b'])
+
+    def test_declared_waits_for_earlier_barriers_and_its_dependencies(self):
+        libs, _ = libraries(
+            1,
+            {'name': 'gcc'},
+            {'name': 'zlib', 'depends_on': []},
+            {'name': 'bzip2', 'depends_on': []},
+            {'name': 'png', 'depends_on': ['zlib']},
+        )
+        s = Scheduler(libs)
+
+        self.assertEqual(names(s.dependencies[libs[1]]), ['gcc'])
+        self.assertEqual(names(s.dependencies[libs[2]]), ['gcc'])
+        self.assertEqual(names(s.dependencies[libs[3]]), ['gcc', 'zlib'])
+
+    def test_dependency_uses_closest_earlier_library(self):
+        libs, _ = libraries(
+            1,
+            {'name': 'a', 'depends_on': []},
+            {'name': 'a', 'depends_on': []},
+            {'name': 'b', 'depends_on': ['a']},
+        )
+        s = Scheduler(libs)
+
+        self.assertIs(s.dependencies[libs[2]][0], libs[1])
+
+    def test_unknown_dependency(self):
+        libs, _ = libraries(1, {'name': 'a', 'depends_on': ['b']}, {'name': 'b', 'depends_on': []})
+
+        with self.assertRaises(Exception):
+            Scheduler(libs)
+
+
+class TestPriority(unittest.TestCase):
+
+    def test_longest_chain_goes_first(self):
+        libs, _ = libraries(
+            1,
+            {'name': 'short', 'depends_on': [], 'duration': 10},
+            {'name': 'long', 'depends_on': [], 'duration': 5},
+            {'name': 'after', 'depends_on': ['long'], 'duration': 20},
+        )
+        s = Scheduler(libs)
+
+        self.assertEqual(s.priority[libs[1]], 25)
+        self.assertEqual(names(s.ready(libs, set())), ['long', 'short'])
+
+    def test_unknown_durations_are_estimated(self):
+        libs, _ = libraries(1, {'name': 'a', 'depends_on': []}, {'name': 'b', 'depends_on': []})
+        s = Scheduler(libs)
+
+        self.assertEqual(s.priority[libs[0]], 0)
+        self.assertEqual(names(s.ready(libs, set())), ['a', 'b'])
+
+
+class TestRun(unittest.TestCase):
+
+    def test_dependencies_finish_before_dependents_start(self):
+        libs, log = libraries(
+            4,
+            {'name': 'gcc'},
+            {'name': 'zlib', 'depends_on': []},
+            {'name': 'bzip2', 'depends_on': []},
+            {'name': 'xz', 'depends_on': []},
+            {'name': 'png', 'depends_on': ['zlib']},
+            {'name': 'last'},
+        )
+        s = Scheduler(libs, jobs=4)
+        s.run()
+
+        for l in libs:
+            for d in s.dependencies[l]:
+                self.assertLess(log.index(('end', d.name)), log.index(('start', l.name)))
+
+        self.assertTrue(all(l.prepared for l in libs))
+
+    def test_independent_libraries_build_together(self):
+        libs, log = libraries(3, *({'name': str(i), 'depends_on': []} for i in range(3)))
+        Scheduler(libs, jobs=3).run()
+
+        # Everything started before anything finished
+        self.assertEqual([e[0] for e in log[:3]], ['start'] * 3)
+
+    def test_jobs_limit_builds(self):
+        libs, log = libraries(2, *({'name': str(i), 'depends_on': []} for i in range(4)))
+        Scheduler(libs, jobs=2).run()
+
+        running = 0
+        for event, _ in log:
+            running += 1 if event == 'start' else -1
+            self.assertLessEqual(running, 2)
+
+    def test_failure_stops_scheduling(self):
+        libs, log = libraries(1, {'name': 'a', 'fail': True}, {'name': 'b'})
+
+        with self.assertRaises(Exception):
+            Scheduler(libs, jobs=1).run()
+
+        self.assertNotIn(('start', 'b'), log)
+
+    def test_build_holds_a_job(self):
+        libs, _ = libraries(1, {'name': 'a'})
+        jobserver = libs[0].toolchain.state['jobserver']
+        seen = []
+
+        def build(state, dependencies):
+            seen.append(jobserver.running)
+
+        libs[0].build = build
+        Scheduler(libs).run()
+
+        self.assertEqual(seen, [1])
+        self.assertEqual(jobserver.running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from reel.util import StateStore, get_status, update_status, is_complete, set_complete
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        StateStore._current = None
+        self.addCleanup(setattr, StateStore, '_current', None)
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        self.status_dir = os.path.join(self.root, 'status')
+        self.status_file = os.path.join(self.status_dir, 'pkg.json')
+
+    def open(self):
+        return StateStore.open(os.path.join(self.root, 'state.db'))
+
+
+class TestJSON(StateStoreTest):
+
+    def test_update(self):
+        update_status(self.status_file, {'configure': 'a'})
+        update_status(self.status_file, {'build': 'b'})
+
+        with open(self.status_file, 'r') as f:
+            self.assertEqual(json.load(f), {'configure': 'a', 'build': 'b'})
+
+        # Nothing is left from writing it
+        self.assertEqual(os.listdir(self.status_dir), ['pkg.json'])
+
+
+class TestStateStore(StateStoreTest):
+
+    def test_status(self):
+        self.open()
+
+        self.assertEqual(get_status(self.status_file), {})
+        set_complete(self.status_file, 'configure', fingerprint='a')
+
+        self.assertTrue(is_complete(self.status_file, 'configure', fingerprint='a'))
+        self.assertFalse(is_complete(self.status_file, 'configure', fingerprint='b'))
+        self.assertFalse(os.path.exists(self.status_file))
+
+    def test_migrates_status_files(self):
+        update_status(self.status_file, {'configure': 'a'})
+        self.open()
+
+        self.assertEqual(get_status(self.status_file), {'configure': 'a'})
+        self.assertFalse(os.path.exists(self.status_file))
+
+        # It is still there once the file has gone
+        update_status(self.status_file, {'build': 'b'})
+        self.assertEqual(get_status(self.status_file), {'configure': 'a', 'build': 'b'})
+
+    def test_deleted_folder_starts_again(self):
+        self.open()
+        update_status(self.status_file, {'configure': 'a'})
+        update_status(os.path.join(self.status_dir, 'sub', 'other.json'), {'build': 'b'})
+
+        shutil.rmtree(self.status_dir)
+
+        self.assertEqual(get_status(os.path.join(self.status_dir, 'sub', 'other.json')), {})
+        self.assertEqual(get_status(self.status_file), {})
+
+    def test_remove(self):
+        store = self.open()
+        update_status(self.status_file, {'configure': 'a'})
+        update_status(os.path.join(self.root, 'status_other', 'pkg.json'), {'configure': 'a'})
+
+        store.remove(self.status_dir)
+
+        self.assertEqual(get_status(self.status_file), {})
+        self.assertEqual(get_status(os.path.join(self.root, 'status_other', 'pkg.json')), {'configure': 'a'})
+
+    def test_updates_from_many_threads(self):
+        self.open()
+
+        def update(i):
+            for j in range(20):
+                update_status(self.status_file, {'{}_{}'.format(i, j): True})
+
+        threads = [threading.Thread(target=update, args=(i, )) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(get_status(self.status_file)), 80)
+
+
+if __name__ == '__main__':
+    unittest.main()
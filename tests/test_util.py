@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+from unittest import mock
+
+from reel.util import is_selected, get_env_changes
+
+
+class TestIsSelected(unittest.TestCase):
+
+    def test_everything_by_default(self):
+        self.assertTrue(is_selected('src/main.c'))
+
+    def test_include(self):
+        self.assertTrue(is_selected('include/a.h', include=['include']))
+        self.assertTrue(is_selected('include/sub/a.h', include=['include']))
+        self.assertFalse(is_selected('src/a.c', include=['include']))
+
+    def test_exclude(self):
+        self.assertFalse(is_selected('doc/index.html', exclude=['doc']))
+        self.assertTrue(is_selected('docs/index.html', exclude=['doc']))
+        self.assertTrue(is_selected('src/doc.c', exclude=['doc']))
+
+    def test_patterns(self):
+        self.assertTrue(is_selected('src/a.c', include=['*.c']))
+        self.assertFalse(is_selected('src/test_a.c', include=['src'], exclude=['*/test_*']))
+
+    def test_exclude_wins(self):
+        self.assertFalse(is_selected('src/test/a.c', include=['src'], exclude=['src/test']))
+
+
+class TestGetEnvChanges(unittest.TestCase):
+
+    def test_only_what_we_add(self):
+        with mock.patch.dict(os.environ, {'HOME': '/home/me', 'CC': 'gcc'}, clear=True):
+            self.assertEqual(get_env_changes({'HOME': '/home/me', 'CC': 'clang', 'CFLAGS': '-O2'}), {
+                'CC': 'clang',
+                'CFLAGS': '-O2',
+            })
+
+    def test_paths_we_extend(self):
+        with mock.patch.dict(os.environ, {'PATH': '/usr/bin:/bin'}, clear=True):
+            self.assertEqual(
+                get_env_changes({'PATH': '/opt/bin:/usr/bin:/bin'}),
+                {'PATH': '/opt/bin:${PATH}'},
+            )
+            self.assertEqual(
+                get_env_changes({'PATH': '/usr/bin:/bin:/opt/bin'}),
+                {'PATH': '${PATH}:/opt/bin'},
+            )
+
+    def test_same_on_every_machine(self):
+        env = {'PATH': '/opt/bin:/usr/bin'}
+        with mock.patch.dict(os.environ, {'PATH': '/usr/bin'}, clear=True):
+            first = get_env_changes(dict(env))
+
+        env = {'PATH': '/opt/bin:/usr/local/bin:/usr/bin'}
+        with mock.patch.dict(os.environ, {'PATH': '/usr/local/bin:/usr/bin'}, clear=True):
+            self.assertEqual(get_env_changes(env), first)
+
+
+if __name__ == '__main__':
+    unittest.main()